@@ -0,0 +1,429 @@
+#!/usr/bin/python
+#
+# Blogger to Ikiwiki conversion tool -- benchmarks
+# Copyright (C) 2012  Francois Marier <francois@fmarier.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import cProfile
+import json
+import multiprocessing
+import optparse
+import os
+import pstats
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+from xml.sax.saxutils import escape, quoteattr
+
+import blogger2ikiwiki
+import html2text
+
+
+def blogger_html(size):
+    """Post HTML of roughly size bytes, in the style Blogger exports."""
+    paragraph = (
+        u"<p>Some text with <tt>apt-get</tt> and <code>ls -l</code> in it, "
+        u"<tt><b>bold</b></tt> and <a href='http://example.com/'>a link</a>.</p>"
+        u"<blockquote><pre>$ ls -l\n<b>total</b> 0</pre></blockquote>"
+        u"<ul><li>one<br /></li><li>two &rsquo;quoted&rsquo; &mdash; item</li></ul>"
+        u"A plain paragraph with <i>emphasis</i> and <b>bold</b> text.<br /><br />"
+    )
+    return paragraph * (size // len(paragraph) + 1)
+
+
+def export_html(filename):
+    """The HTML of every post and comment of a Blogger export."""
+    html = []
+    for entry in blogger2ikiwiki.iter_entries(filename):
+        html.append(entry.content)
+    return html
+
+
+def marked_up_text(size):
+    """Converted text of roughly size bytes, as HTML2Text leaves it."""
+    paragraph = [
+        "Some text with <!-- START TT -->apt-get<!-- END TT WITHOUT TAGS --> in it",
+        "and <!-- START CODE -->ls <b>-l</b><!-- END CODE WITH TAGS --> as well.",
+        "",
+        "<!-- START PRE -->",
+        "    $ ls -l",
+        "    <b>total</b> 0 &lt;x&gt;",
+        "<!-- END PRE WITH TAGS -->",
+        "",
+        "<!-- START PRE -->",
+        "    plain pre",
+        "<!-- END PRE WITHOUT TAGS -->",
+        "",
+        "A plain paragraph with [a link](http://example.com/) and **bold** text.",
+        "",
+    ]
+    paragraph = "\n".join(paragraph) + "\n"
+    return paragraph * (size // len(paragraph) + 1)
+
+
+# Building blocks of the synthetic posts and comments
+SNIPPETS = {
+    'pre': u"<blockquote><pre>$ ls -l\n<b>total</b> 0\n&lt;x&gt;</pre></blockquote>",
+    'tt': u"Install it with <tt>apt-get</tt> or <tt><b>aptitude</b></tt>.<br />",
+    'code': u"Then run <code>ls <b>-l</b></code> in <code>/tmp</code>.<br />",
+    'image': (u"<a href='http://1.bp.blogspot.com/-a/AAAA/s1600-h/%(n)d.jpg'>"
+              u"<img src='http://1.bp.blogspot.com/-a/AAAA/s320/%(n)d.jpg' /></a>"),
+    'link': u"See <a href='http://example.com/%(n)d.html'>this page</a> for details.<br />",
+    'text': u"A plain paragraph with <i>emphasis</i> &mdash; and <b>bold</b> text.<br /><br />",
+}
+DEFAULT_MIX = 'pre=1,tt=1,code=1,image=1,link=2,text=4'
+
+STAGES = ['parse', 'html_fixups', 'html2text', 'post_process', 'write']
+
+# Number of random documents compared by --check for the HTML fix-ups
+FIXUP_CHECK_DOCUMENTS = 50000
+
+
+def parse_mix(mix):
+    """Turn 'pre=1,text=4' into the list of snippets to pick from."""
+    choices = []
+    for item in mix.split(','):
+        (name, weight) = item.split('=')
+        if name not in SNIPPETS:
+            raise ValueError('unknown content type: %s' % name)
+        choices += [name] * int(weight)
+    if not choices:
+        raise ValueError('empty content mix')
+    return choices
+
+
+def synthetic_export(f, posts, comments, paragraphs, mix, seed=0):
+    """Write a Blogger export with the given number of posts, each with
+    the given number of comments, made out of the snippets in mix."""
+    rng = random.Random(seed)
+    def content(count):
+        html = u''.join(SNIPPETS[rng.choice(mix)] for i in range(count))
+        return escape(html % {'n': rng.randint(0, 1000)})
+
+    f.write("<?xml version='1.0' encoding='UTF-8'?>"
+            "<feed xmlns='http://www.w3.org/2005/Atom' "
+            "xmlns:thr='http://purl.org/syndication/thread/1.0'>"
+            "<id>tag:blogger.com,1999:blog-1</id><title type='text'>Blog</title>")
+    for i in range(posts):
+        post_id = 'tag:blogger.com,1999:blog-1.post-%d' % i
+        link = 'http://feeding.cloud.geek.nz/%d/%02d/post-%d.html' % (2008 + i // 365, i % 12 + 1, i)
+        f.write((u"<entry><id>%s</id>"
+                 u"<published>2012-01-01T10:00:00.000+13:00</published>"
+                 u"<updated>2012-02-01T10:00:00.000+13:00</updated>"
+                 u"<category scheme='http://schemas.google.com/g/2005#kind' "
+                 u"term='http://schemas.google.com/blogger/2008/kind#post'/>"
+                 u"<category scheme='http://www.blogger.com/atom/ns#' term='debian'/>"
+                 u"<title type='text'>Post number %d</title>"
+                 u"<content type='html'>%s</content>"
+                 u"<link rel='alternate' type='text/html' href=%s/>"
+                 u"<author><name>Author</name></author></entry>"
+                 % (post_id, i, content(paragraphs), quoteattr(link))).encode('utf8'))
+        for j in range(comments):
+            f.write((u"<entry><id>%s-%d</id>"
+                     u"<published>2012-03-01T10:%02d:00.000+13:00</published>"
+                     u"<updated>2012-03-01T10:00:00.000+13:00</updated>"
+                     u"<category scheme='http://schemas.google.com/g/2005#kind' "
+                     u"term='http://schemas.google.com/blogger/2008/kind#comment'/>"
+                     u"<title type='text'>Comment</title>"
+                     u"<content type='html'>%s</content>"
+                     u"<link rel='alternate' type='text/html' href=%s/>"
+                     u"<author><name>Commenter %d</name><uri>http://example.com/</uri></author>"
+                     u"<thr:in-reply-to ref='%s' type='text/html'/></entry>"
+                     % (post_id, j, j % 60, content(2), quoteattr(link + '?showComment=%d' % j),
+                        j, post_id)).encode('utf8'))
+    f.write("</feed>")
+
+
+def sample_html(options):
+    if options.export:
+        return export_html(options.export)
+    return [blogger_html(options.size)]
+
+
+def bench_post_process_markers(options):
+    text = marked_up_text(options.size)
+    return lambda: blogger2ikiwiki.post_process_markers(text)
+
+
+def bench_html_fixups(options):
+    documents = sample_html(options)
+    converter = blogger2ikiwiki.Converter(options.export)
+    def run():
+        for html in documents:
+            converter.fix_html(html, False)
+    return run
+
+
+def bench_html2text(options):
+    documents = sample_html(options)
+    def run():
+        for html in documents:
+            html2text.html2text(html)
+    return run
+
+
+def check_fast_path(documents):
+    """Documents whose conversion differs between the fast path and HTMLParser."""
+    mismatches = []
+    for html in documents:
+        outputs = []
+        for fast_path in (True, False):
+            h = html2text.HTML2Text()
+            h.fast_path = fast_path
+            outputs.append(h.handle(html))
+        if outputs[0] != outputs[1]:
+            mismatches.append(html)
+    return mismatches
+
+
+def chained_fixups(rules, html):
+    """What compile_fixups(rules) must give: one str.replace() per rule."""
+    for (old, new) in rules:
+        html = html.replace(old, new)
+    return html
+
+
+def check_html_fixups(count, seed=0):
+    """Random documents made of the strings of the built-in fix-up rules,
+    and pieces of them, whose compiled fix-ups differ from chained ones."""
+    rule_sets = [blogger2ikiwiki.HTML_FIXUPS,
+                 blogger2ikiwiki.HTML_FIXUPS + blogger2ikiwiki.COMMENT_HTML_FIXUPS]
+    alphabet = set([u'x', u' ', u'<', u'>', u'/', u'#', u'*', u'-'])
+    for rules in rule_sets:
+        for rule in rules:
+            for string in rule:
+                alphabet.add(string)
+                # Every split at a tag boundary, so that rules can meet halfway
+                for i in range(1, len(string)):
+                    if string[i] == '<' or string[i - 1] == '>':
+                        alphabet.update([string[:i], string[i:]])
+    alphabet = sorted(alphabet)
+
+    compiled = [(rules, blogger2ikiwiki.compile_fixups(rules)) for rules in rule_sets]
+    rng = random.Random(seed)
+    mismatches = []
+    for i in range(count):
+        html = u''.join(rng.choice(alphabet) for j in range(rng.randint(1, 12)))
+        for (rules, fixups) in compiled:
+            if fixups(html) != chained_fixups(rules, html):
+                mismatches.append(html)
+                break
+    return mismatches
+
+
+def page_filename(entry):
+    return blogger2ikiwiki.extract_filename(blogger2ikiwiki.get_page_permalink(entry))
+
+
+def convert_stages(export, directory):
+    """Convert an export into directory, one stage at a time over all of
+    its entries, and return the seconds spent in each stage."""
+    converter = blogger2ikiwiki.Converter(export, directory)
+    times = {}
+
+    start = time.time()
+    entries = list(blogger2ikiwiki.iter_entries(export))
+    times['parse'] = time.time() - start
+
+    start = time.time()
+    documents = [converter.fix_html(entry.content, entry.kind == 'comment')
+                 for entry in entries]
+    times['html_fixups'] = time.time() - start
+
+    start = time.time()
+    texts = [html2text.html2text(html) for html in documents]
+    times['html2text'] = time.time() - start
+
+    start = time.time()
+    pages = []
+    for (entry, text) in zip(entries, texts):
+        filename = page_filename(entry)
+        pages.append((filename, blogger2ikiwiki.post_process(text, filename,
+                                                             entry.kind == 'comment')))
+    times['post_process'] = time.time() - start
+    del blogger2ikiwiki.image_requests[:]
+
+    start = time.time()
+    for (entry, (filename, page)) in zip(entries, pages):
+        if entry.kind == 'post':
+            converter.save_post(filename, page)
+        else:
+            converter.save_comment(filename, entry, page)
+    times['write'] = time.time() - start
+    return times
+
+
+def bench_stages(options):
+    """Time each stage of a whole conversion, keeping the fastest runs."""
+    best = {}
+    for i in range(options.number):
+        directory = tempfile.mkdtemp(prefix='benchmark-')
+        try:
+            times = convert_stages(options.export, directory)
+        finally:
+            shutil.rmtree(directory)
+        for stage in STAGES:
+            best[stage] = min(best.get(stage, times[stage]), times[stage])
+
+    if options.profile:
+        directory = tempfile.mkdtemp(prefix='benchmark-')
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(convert_stages, options.export, directory)
+        finally:
+            shutil.rmtree(directory)
+        pstats.Stats(profiler).sort_stats('time').print_stats(10)
+    return best
+
+
+BENCHMARKS = [
+    ('html_fixups', bench_html_fixups),
+    ('html2text', bench_html2text),
+    ('post_process_markers', bench_post_process_markers),
+]
+
+
+def run_benchmark(name, options):
+    """Run one benchmark and return its result along with its peak memory.
+
+    This runs in a process of its own so that the memory used by one
+    benchmark does not show up in the figures of the next ones.
+    """
+    if name == 'stages':
+        result = {'stages': dict((stage, seconds * 1000) for (stage, seconds)
+                                 in bench_stages(options).items())}
+        result['time'] = sum(result['stages'].values())
+    else:
+        function = dict(BENCHMARKS)[name](options)
+        best = min(timeit.repeat(function, number=1, repeat=options.number))
+        result = {'time': best * 1000}
+
+        if options.profile:
+            profiler = cProfile.Profile()
+            profiler.runcall(function)
+            pstats.Stats(profiler).sort_stats('time').print_stats(10)
+
+    # Kilobytes on Linux
+    result['peak_memory'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return result
+
+
+def main():
+    p = optparse.OptionParser('%prog [options] [benchmark...]')
+    p.add_option("-s", "--size", dest="size", action="store", type="int",
+        default=1024 * 1024, help="approximate size in bytes of each input")
+    p.add_option("-n", "--number", dest="number", action="store", type="int",
+        default=5, help="number of runs, the fastest one is reported")
+    p.add_option("-e", "--export", dest="export", action="store",
+        help="use the posts and comments of this Blogger export as input")
+    p.add_option("-p", "--profile", dest="profile", action="store_true",
+        default=False, help="print the functions taking the most time in each benchmark")
+    p.add_option("-P", "--posts", dest="posts", action="store", type="int",
+        default=100, help="number of posts in the synthetic export")
+    p.add_option("-C", "--comments", dest="comments", action="store", type="int",
+        default=3, help="number of comments on each post of the synthetic export")
+    p.add_option("--paragraphs", dest="paragraphs", action="store", type="int",
+        default=20, help="number of snippets making up each synthetic post")
+    p.add_option("-m", "--mix", dest="mix", action="store", default=DEFAULT_MIX,
+        help="relative weights of the snippets of synthetic posts [default: %default]")
+    p.add_option("-g", "--generate", dest="generate", action="store", metavar="FILE",
+        help="only write the synthetic export to FILE")
+    p.add_option("-o", "--output", dest="output", action="store", metavar="FILE",
+        help="write the results to FILE as JSON")
+    p.add_option("-c", "--check", dest="check", action="store_true", default=False,
+        help="only check that the html2text fast path matches the full parser on every "
+             "entry, and the compiled HTML fix-ups the chained ones on random documents")
+    (options, args) = p.parse_args()
+
+    try:
+        mix = parse_mix(options.mix)
+    except ValueError as e:
+        p.error('invalid --mix: %s' % e)
+
+    if options.generate:
+        with open(options.generate, 'wb') as f:
+            synthetic_export(f, options.posts, options.comments, options.paragraphs, mix)
+        return
+
+    names = [name for (name, setup) in BENCHMARKS] + ['stages']
+    for name in args:
+        if name not in names:
+            p.error('unknown benchmark: %s' % name)
+
+    synthetic = None
+    if options.export is None and (options.check or not args or 'stages' in args):
+        (handle, synthetic) = tempfile.mkstemp(prefix='benchmark-', suffix='.xml')
+        with os.fdopen(handle, 'wb') as f:
+            synthetic_export(f, options.posts, options.comments, options.paragraphs, mix)
+
+    if options.check:
+        try:
+            documents = export_html(options.export or synthetic)
+        finally:
+            if synthetic:
+                os.remove(synthetic)
+        mismatches = check_fast_path(documents)
+        fast = len([html for html in documents if html2text.simple_tokens(html) is not None])
+        print '%d entries, %d on the fast path, %d mismatches' % (len(documents), fast, len(mismatches))
+        for html in mismatches[:5]:
+            print repr(html[:200])
+
+        fixup_mismatches = check_html_fixups(FIXUP_CHECK_DOCUMENTS)
+        print '%d HTML fix-up documents, %d mismatches' % (FIXUP_CHECK_DOCUMENTS,
+                                                            len(fixup_mismatches))
+        for html in fixup_mismatches[:5]:
+            print repr(html)
+        return 1 if mismatches or fixup_mismatches else 0
+
+    results = {}
+    try:
+        for name in names:
+            if args and name not in args:
+                continue
+
+            benchmark_options = options
+            if name == 'stages' and synthetic:
+                benchmark_options = optparse.Values(vars(options))
+                benchmark_options.export = synthetic
+
+            pool = multiprocessing.Pool(1)
+            result = pool.apply(run_benchmark, (name, benchmark_options))
+            pool.close()
+            pool.join()
+            results[name] = result
+
+            print '%-30s %10.2f ms %10d kB' % (name, result['time'], result['peak_memory'])
+            for stage in STAGES:
+                if stage in result.get('stages', {}):
+                    print '  %-28s %10.2f ms' % (stage, result['stages'][stage])
+    finally:
+        if synthetic:
+            os.remove(synthetic)
+
+    if options.output:
+        settings = dict((key, getattr(options, key)) for key in
+                        ('size', 'number', 'export', 'posts', 'comments', 'paragraphs', 'mix'))
+        with open(options.output, 'w') as f:
+            json.dump({'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'options': settings,
+                       'results': results}, f, indent=1, sort_keys=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
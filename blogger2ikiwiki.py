@@ -17,70 +17,196 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-from hashlib import md5
+import cProfile
+import filecmp
+from hashlib import md5, sha1
+import itertools
+import json
+import multiprocessing
+import optparse
 import os
+import Queue
 import re
+import shlex
+import shutil
 import sys
+import threading
+import time
 import urllib2
 from urlparse import urlparse
-import xml.dom.minidom as minidom
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
 
-from html2text import html2text
+import html2text as html2text_module
 
 
-# Change this to point to the name of your Blogger export file
-ATOM_BACKUP_FILENAME = '../feedingthecloud.xml'
+# Number of images downloaded in parallel, and at most how many of those
+# may hit the same host at once
+IMAGE_DOWNLOAD_THREADS = 8
+IMAGE_DOWNLOADS_PER_HOST = 4
 
-LICENSE_LINK = '[Creative Commons Attribution-Share Alike 3.0 New Zealand License](http://creativecommons.org/licenses/by-sa/3.0/nz/)'
+# How many times a failed image download is attempted before giving up
+IMAGE_DOWNLOAD_ATTEMPTS = 3
 
-AUTHOR_URL_REPLACEMENTS = {'http://www.blogger.com/profile/15799633745688818389': 'http://fmarier.org'}
+# Images which still failed are queued again once all the others are done,
+# up to this many times
+IMAGE_RETRY_ROUNDS = 1
 
-# Must include the trailing slash!
-BLOG_URL = 'http://feeding.cloud.geek.nz/'
+# Downloaded images are kept here between runs and only revalidated with
+# the server afterwards. The least recently used ones are evicted once the
+# cache grows past IMAGE_CACHE_SIZE bytes.
+IMAGE_CACHE_DIRECTORY = os.path.expanduser('~/.cache/blogger2ikiwiki/images')
+IMAGE_CACHE_SIZE = 512 * 1024 * 1024
 
-TAGGED_FEEDS = ['debian', 'mozilla', 'nzoss', 'ubuntu', 'postgres', 'sysadmin', 'django', 'python', 'nodejs']
+# Records which entry produced which output files, next to those files
+MANIFEST_FILENAME = '.blogger2ikiwiki-manifest.json'
+
+# Records the entries finished so far while a conversion is running, so
+# that an interrupted one can pick up where it stopped
+JOURNAL_FILENAME = '.blogger2ikiwiki-journal'
+
+# Number of entries listed in the --profile report
+PROFILE_SLOWEST_ENTRIES = 10
+
+# The conversion code hashed into the manifest, resolved now so that it is
+# still found whatever the working directory is by the time it is read
+SOURCE_FILENAMES = [os.path.splitext(os.path.abspath(__file__))[0] + '.py',
+                    os.path.splitext(os.path.abspath(html2text_module.__file__))[0] + '.py']
+
+
+ATOM = '{http://www.w3.org/2005/Atom}'
+THREADING = '{http://purl.org/syndication/thread/1.0}'
+
+KIND_SCHEME = 'http://schemas.google.com/g/2005#kind'
+TAG_SCHEME = 'http://www.blogger.com/atom/ns#'
+POST_KIND = 'http://schemas.google.com/blogger/2008/kind#post'
+COMMENT_KIND = 'http://schemas.google.com/blogger/2008/kind#comment'
+
+
+class Entry(object):
+    """The parts of an exported post or comment which get converted."""
+
+    fields = ('id', 'published', 'updated', 'title', 'permalink',
+              'author_name', 'author_uri', 'content')
+    __slots__ = fields
+    kind = None
+
+    def __init__(self):
+        for field in self.fields:
+            setattr(self, field, None)
+
+
+class Post(Entry):
+    fields = Entry.fields + ('tags',)
+    __slots__ = ('tags',)
+    kind = 'post'
+
+
+class Comment(Entry):
+    # Only the permalink of the post is kept, as comments are pickled
+    # over to the worker processes
+    fields = Entry.fields + ('post_id', 'post_permalink')
+    __slots__ = ('post_id', 'post_permalink')
+    kind = 'comment'
+
+
+def element_text(element):
+    # Plain ASCII text comes back as a str
+    return unicode(element.text or u'')
+
+
+def read_entry(element):
+    """Turn an <entry> element into a Post or a Comment in a single pass.
+
+    Returns None for the other kinds of entries (settings, template...).
+    Only the first of each element counts, like getElementsByTagName()
+    would have it.
+    """
+    kinds = set()
+    tags = []
+    fields = {}
+    author = None
+
+    for child in element:
+        name = child.tag
+        if name == ATOM + 'category':
+            scheme = child.get('scheme')
+            if scheme == KIND_SCHEME:
+                kinds.add(child.get('term'))
+            elif scheme == TAG_SCHEME:
+                tags.append(child.get('term'))
+        elif name == ATOM + 'link':
+            if ('permalink' not in fields and child.get('rel') == 'alternate'
+                    and child.get('type') == 'text/html'):
+                fields['permalink'] = child.get('href').split('?')[0]
+        elif name == ATOM + 'author':
+            if author is None:
+                author = child
+        elif name == THREADING + 'in-reply-to':
+            fields.setdefault('post_id', child.get('ref'))
+        elif name.startswith(ATOM):
+            name = name[len(ATOM):]
+            if name in Entry.fields and name not in fields:
+                fields[name] = element_text(child)
+
+    if author is not None:
+        for field in author:
+            if field.tag == ATOM + 'name':
+                fields.setdefault('author_name', element_text(field))
+            elif field.tag == ATOM + 'uri':
+                fields.setdefault('author_uri', element_text(field))
+
+    # A post stays a post, whatever else it is tagged as
+    if POST_KIND in kinds:
+        entry = Post()
+        entry.tags = tags
+    elif COMMENT_KIND in kinds:
+        entry = Comment()
+    else:
+        return None
+
+    for (name, value) in fields.items():
+        if name in entry.fields:
+            setattr(entry, name, value)
+    return entry
 
 
 def get_author_name(entry):
-    author = entry.getElementsByTagName('author').item(0)
-    nametag = author.getElementsByTagName('name').item(0)
-    textnode = nametag.firstChild
-    return textnode.nodeValue
-
-
-def get_author_uri(entry):
-    author = entry.getElementsByTagName('author').item(0)
-    uritags = author.getElementsByTagName('uri')
-    if uritags:
-        textnode = uritags.item(0).firstChild
-        url = textnode.nodeValue
-        if url in AUTHOR_URL_REPLACEMENTS:
-            return AUTHOR_URL_REPLACEMENTS[url]
-        else:
-            return url
-    return None
+    return entry.author_name
+
+
+def get_id(entry):
+    return entry.id
 
 
 def get_date(entry, datename):
-    datetag = entry.getElementsByTagName(datename).item(0)
-    textnode = datetag.firstChild
-    return textnode.nodeValue
+    return getattr(entry, datename)
 
 
 def get_title(entry):
-    titletag = entry.getElementsByTagName('title').item(0)
-    textnode = titletag.firstChild
-    return textnode.nodeValue
+    return entry.title
 
 
 def get_permalink(entry):
-    links = entry.getElementsByTagName('link')
-    for link in links:
-        schemeattr = link.getAttribute('rel')
-        typeattr = link.getAttribute('type')
-        if schemeattr == 'alternate' and typeattr == 'text/html':
-            href = link.getAttribute('href').split('?')
-            return href[0]
+    return entry.permalink
+
+
+def get_tags(entry):
+    return entry.tags
+
+
+def get_page_permalink(entry):
+    """The permalink of the page an entry goes on.
+
+    Without a link of its own, a comment goes on its post's page.
+    """
+    permalink = get_permalink(entry)
+    if permalink is None and entry.kind == 'comment':
+        permalink = entry.post_permalink
+    return permalink
+
 
 def escape_most_tags(line):
     line = line.replace('<i>', 'OPEN_BRACKET_I_CLOSE_BRACKET')
@@ -98,58 +224,324 @@ def escape_most_tags(line):
     return line
 
 
-def post_process_pre(text):
+# Markers which HTML2Text wraps <tt> and <code> contents with: the start
+# marker and, for each way the run can end, the end marker along with what
+# both markers get replaced by
+INLINE_MARKERS = [
+    ('<!-- START TT -->',
+     [('<!-- END TT WITHOUT TAGS -->', '`', '`'),
+      ('<!-- END TT WITH TAGS -->', '<tt>', '</tt>')]),
+    ('<!-- START CODE -->',
+     [('<!-- END CODE WITHOUT TAGS -->', '`', '`'),
+      ('<!-- END CODE WITH TAGS -->', '<code>', '</code>')]),
+]
+
+START_PRE = 0
+END_PRE_WITHOUT_TAGS = 1
+END_PRE_WITH_TAGS = 2
+PRE_MARKERS = {
+    '<!-- START PRE -->': START_PRE,
+    '<!-- END PRE WITHOUT TAGS -->': END_PRE_WITHOUT_TAGS,
+    '<!-- END PRE WITH TAGS -->': END_PRE_WITH_TAGS,
+}
+
+
+def resolve_inline_markers(line):
+    """Turn the TT and CODE markers of one line into Markdown or HTML.
+
+    Returns None for a line with a start marker but no matching end
+    marker, which gets dropped.
+    """
+    for (start, ends) in INLINE_MARKERS:
+        if start in line:
+            for (end, open_tag, close_tag) in ends:
+                if end in line:
+                    return line.replace(start, open_tag).replace(end, close_tag)
+            return None
+    return line
+
+
+def post_process_markers(text):
+    """Resolve the PRE, TT and CODE markers left by HTML2Text in one pass."""
     out = []
+    append = out.append
 
-    lines = text.split("\n")
     in_pre = False
     pre_lines = []
-    for line in lines:
-        if "<!-- START PRE -->" == line:
+    for line in text.split("\n"):
+        if '<!-- ' not in line:
+            if in_pre:
+                pre_lines.append(line)
+            else:
+                append(line)
+            continue
+
+        marker = PRE_MARKERS.get(line)
+        if marker is None:
+            if in_pre:
+                pre_lines.append(line)
+            else:
+                line = resolve_inline_markers(line)
+                if line is not None:
+                    append(line)
+        elif marker == START_PRE:
             in_pre = True
             pre_lines = []
-        elif "<!-- END PRE WITHOUT TAGS -->" == line:
+        elif marker == END_PRE_WITHOUT_TAGS:
             in_pre = False
-            out.append('')
-            out += pre_lines
-            out.append('')
-        elif "<!-- END PRE WITH TAGS -->" == line:
+            append('')
+            for l in pre_lines:
+                if '<!-- START ' in l:
+                    l = resolve_inline_markers(l)
+                    if l is None:
+                        continue
+                append(l)
+            append('')
+        else:
             in_pre = False
-            out.append('<pre>')
+            append('<pre>')
             # remove the indentation and add <pre> and </pre> tags
             for l in pre_lines:
-                out.append(escape_most_tags(l[4:]))
-            out.append('</pre>')
-        elif in_pre:
-            pre_lines.append(line)
-        else:
-            out.append(line)
+                append(escape_most_tags(l[4:]))
+            append('</pre>')
 
     return "\n".join(out)
 
 
-def post_process_tt_code(text):
-    out = []
-
-    lines = text.split("\n")
-    in_pre = False
-    pre_lines = []
-    for line in lines:
-        if "<!-- START TT -->" in line:
-            if "<!-- END TT WITHOUT TAGS -->" in line:
-                out.append(line.replace('<!-- START TT -->', '`').replace('<!-- END TT WITHOUT TAGS -->', '`'))
-            elif "<!-- END TT WITH TAGS -->" in line:
-                out.append(line.replace('<!-- START TT -->', '<tt>').replace('<!-- END TT WITH TAGS -->', '</tt>'))
-        elif "<!-- START CODE -->" in line:
-            if "<!-- END CODE WITHOUT TAGS -->" in line:
-                out.append(line.replace('<!-- START CODE -->', '`').replace('<!-- END CODE WITHOUT TAGS -->', '`'))
-            elif "<!-- END CODE WITH TAGS -->" in line:
-                out.append(line.replace('<!-- START CODE -->', '<code>').replace('<!-- END CODE WITH TAGS -->', '</code>'))
-        else:
-            out.append(line)
-
-    return "\n".join(out)
-
+class ImageCache(object):
+    """On-disk image store shared across runs.
+
+    Image contents are stored once under their SHA-1 hash and the index
+    maps each source URL to that hash along with the ETag and
+    Last-Modified headers needed to revalidate it.
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.index_filename = os.path.join(directory, 'index.json')
+        self.validated = set() # URLs already checked with the server this run
+
+        self.index = {}
+        if os.path.isfile(self.index_filename):
+            with open(self.index_filename) as f:
+                self.index = json.load(f)
+
+    def blob_path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest[2:])
+
+    def lookup(self, url):
+        """Return the cache entry for url, or None if it isn't usable."""
+        with self.lock:
+            entry = self.index.get(url)
+            if entry and not os.path.isfile(self.blob_path(entry['hash'])):
+                del self.index[url]
+                entry = None
+            return entry
+
+    def request_headers(self, entry):
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def store(self, url, contents, headers):
+        digest = sha1(contents).hexdigest()
+        path = self.blob_path(digest)
+        with self.lock:
+            if not os.path.isfile(path):
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                temp_path = path + '.tmp.%d' % threading.current_thread().ident
+                with open(temp_path, 'wb') as f:
+                    f.write(contents)
+                os.rename(temp_path, path)
+
+            previous = self.index.get(url)
+            self.index[url] = {'hash': digest, 'size': len(contents),
+                               'etag': headers.get('ETag'),
+                               'last_modified': headers.get('Last-Modified'),
+                               'used': time.time()}
+            self.validated.add(url)
+
+            # The image changed on the server, its old contents are only
+            # worth keeping if another URL still has them
+            if previous and previous['hash'] != digest:
+                if not any(entry['hash'] == previous['hash'] for entry in self.index.values()):
+                    os.remove(self.blob_path(previous['hash']))
+        return path
+
+    def touch(self, url):
+        with self.lock:
+            self.validated.add(url)
+            entry = self.index[url]
+            entry['used'] = time.time()
+            return self.blob_path(entry['hash'])
+
+    def remove_unindexed(self):
+        """Delete the blobs which no URL of the index refers to, such as
+        those of a run which was killed before saving the index."""
+        indexed = set(entry['hash'] for entry in self.index.values())
+        if not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            subdirectory = os.path.join(self.directory, name)
+            if len(name) != 2 or not os.path.isdir(subdirectory):
+                continue
+            for blob in os.listdir(subdirectory):
+                if name + blob not in indexed:
+                    os.remove(os.path.join(subdirectory, blob))
+
+    def evict(self):
+        """Drop the least recently used images until under max_size."""
+        self.remove_unindexed()
+        blobs = {}
+        for entry in self.index.values():
+            blob = blobs.setdefault(entry['hash'], {'size': entry['size'], 'used': 0})
+            blob['used'] = max(blob['used'], entry['used'])
+
+        total_size = sum(blob['size'] for blob in blobs.values())
+        evicted = set()
+        for (digest, blob) in sorted(blobs.items(), key=lambda item: item[1]['used']):
+            if total_size <= self.max_size:
+                break
+            path = self.blob_path(digest)
+            if os.path.isfile(path):
+                os.remove(path)
+            total_size -= blob['size']
+            evicted.add(digest)
+
+        for (url, entry) in self.index.items():
+            if entry['hash'] in evicted:
+                del self.index[url]
+
+    def save(self):
+        with self.lock:
+            self.evict()
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            with open(self.index_filename + '.tmp', 'w') as f:
+                json.dump(self.index, f)
+            os.rename(self.index_filename + '.tmp', self.index_filename)
+
+
+class ImageDownloader(object):
+    """Download images in the background through a bounded pool of threads.
+
+    Conversion carries on while the images are being fetched: only the
+    local filename is needed to rewrite the Markdown, so callers simply
+    queue downloads and call wait() once every entry has been converted.
+    """
+
+    def __init__(self, threads, per_host, attempts, retry_rounds, cache):
+        self.attempts = attempts
+        self.retry_rounds = retry_rounds
+        self.cache = cache
+        self.per_host = per_host
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.host_slots = {}
+        self.url_locks = {}
+        self.queued = set()
+        self.failed = []
+
+        for i in range(threads):
+            worker = threading.Thread(target=self.worker)
+            worker.daemon = True
+            worker.start()
+
+    def fetch(self, url, destination):
+        with self.lock:
+            if (url, destination) in self.queued:
+                return
+            self.queued.add((url, destination))
+        self.queue.put((url, destination))
+
+    def wait(self):
+        """Block until all queued images are on disk and return the failures.
+
+        Images which could not be downloaded are queued again once all the
+        others are done, in case the server was only briefly unavailable.
+        """
+        self.queue.join()
+        for i in range(self.retry_rounds):
+            with self.lock:
+                (failed, self.failed) = (self.failed, [])
+            if not failed:
+                break
+            for (url, destination, error) in failed:
+                self.queue.put((url, destination))
+            self.queue.join()
+        return [(url, error) for (url, destination, error) in self.failed]
+
+    def host_slot(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.host_slots:
+                self.host_slots[host] = threading.Semaphore(self.per_host)
+            return self.host_slots[host]
+
+    def url_lock(self, url):
+        with self.lock:
+            if url not in self.url_locks:
+                self.url_locks[url] = threading.Lock()
+            return self.url_locks[url]
+
+    def download(self, url, destination):
+        # An image shared by several posts, or blogs, is only fetched once
+        # and then copied out of the cache
+        with self.url_lock(url):
+            self.download_once(url, destination)
+
+    def download_once(self, url, destination):
+        cached = self.cache.lookup(url)
+        if cached and url in self.cache.validated:
+            copy_file(self.cache.touch(url), destination)
+            return
+
+        request = urllib2.Request(url)
+        if cached:
+            for (header, value) in self.cache.request_headers(cached).items():
+                request.add_header(header, value)
+
+        with self.host_slot(url):
+            for attempt in range(1, self.attempts + 1):
+                try:
+                    fh = urllib2.urlopen(request)
+                    path = self.cache.store(url, fh.read(), fh.info())
+                    break
+                except urllib2.HTTPError as e:
+                    if e.code == 304 and cached:
+                        path = self.cache.touch(url)
+                        break
+                    # Only server-side errors are worth trying again
+                    if e.code < 500 or attempt == self.attempts:
+                        raise
+                except IOError:
+                    if attempt == self.attempts:
+                        raise
+                time.sleep(attempt)
+
+        copy_file(path, destination)
+
+    def worker(self):
+        while True:
+            (url, destination) = self.queue.get()
+            try:
+                self.download(url, destination)
+            except Exception as e:
+                with self.lock:
+                    self.failed.append((url, destination, e))
+            finally:
+                self.queue.task_done()
+
+
+# Images found by post_process_images, to be handed to the ImageDownloader
+# once the entry they belong to has been converted
+image_requests = []
 
 image_regexp = re.compile('\[!\[\]\([^)]+\)\]\(([^)]+)\)')
 htmlimage_regexp = re.compile('(\(http://([^.]+.){2}blogspot.com/[^()]+/)s1600-h/')
@@ -166,13 +558,9 @@ def post_process_images(text, image_directory):
         image_url = image.group(1)
         m = filename_regexp.match(image_url)
         if m:
-             fh = urllib2.urlopen(image_url)
-             contents = fh.read()
-
-             # Save to disk
+             # Saved to disk in the background
              filename = m.group(1)
-             with open("%s/%s" % (image_directory, filename), 'w') as f:
-                 f.write(contents)
+             image_requests.append((image_url, "%s/%s" % (image_directory, filename)))
 
              local_images[image_url] = filename
         else:
@@ -190,43 +578,105 @@ def post_process_images(text, image_directory):
 
 
 def post_process(text, post_filename, is_comment):
-    text = post_process_pre(text)
-    text = post_process_tt_code(text)
+    text = post_process_markers(text)
 
     if not is_comment:
         image_directory = post_filename.split('.mdwn')[0]
-        if not os.path.isdir(image_directory):
-            os.mkdir(image_directory)
         text = post_process_images(text, image_directory)
 
     return text
 
 
-def get_content(entry, post_filename, is_comment):
-    contenttag = entry.getElementsByTagName('content').item(0)
-    textnode = contenttag.firstChild
-    html = textnode.nodeValue
-
-    # Fixups for bad interactions later
-    html = html.replace('<blockquote><pre>', '<pre>').replace('</pre></blockquote>', '</pre>')
-    html = html.replace('<blockquote><code>', '<pre>').replace('</code></blockquote>', '</pre>')
-    html = html.replace('<blockquote><tt>', '<pre>').replace('</tt></blockquote>', '</pre>')
-    html = html.replace('</tt><br /></blockquote>', '</pre>')
-    html = html.replace('<pre><blockquote>', '<pre>').replace('</blockquote></pre>', '</pre>')
-    html = html.replace('<tt><b>', '<b><tt>').replace('</b></tt>', '</tt></b>')
-    html = html.replace('<tt><a ', '<a ').replace('</a></tt>', '</a>')
-    html = html.replace('<code></code>', '').replace('<tt></tt>', '')
-    html = html.replace('<br /></li><li>', '</li><li>')
-
-    if is_comment:
-        # Hacks specific to misinterpreted codes in the original plaintext
-        html = html.replace('<BR/>#',  '<br />\#')
-        html = html.replace('<BR/>*',  '<br />\*')
-        html = html.replace('<br />#',  '<br />\#')
-        html = html.replace('<br />-- <br />',  '<br />')
-
-    text = html2text(html)
-    return post_process(text, post_filename, is_comment)
+# Fixups for bad interactions later
+HTML_FIXUPS = [
+    ('<blockquote><pre>', '<pre>'), ('</pre></blockquote>', '</pre>'),
+    ('<blockquote><code>', '<pre>'), ('</code></blockquote>', '</pre>'),
+    ('<blockquote><tt>', '<pre>'), ('</tt></blockquote>', '</pre>'),
+    ('</tt><br /></blockquote>', '</pre>'),
+    ('<pre><blockquote>', '<pre>'), ('</blockquote></pre>', '</pre>'),
+    ('<tt><b>', '<b><tt>'), ('</b></tt>', '</tt></b>'),
+    ('<tt><a ', '<a '), ('</a></tt>', '</a>'),
+    ('<code></code>', ''), ('<tt></tt>', ''),
+    ('<br /></li><li>', '</li><li>'),
+]
+
+# Hacks specific to misinterpreted codes in the original plaintext
+COMMENT_HTML_FIXUPS = [
+    ('<BR/>#',  '<br />\#'),
+    ('<BR/>*',  '<br />\*'),
+    ('<br />#',  '<br />\#'),
+    ('<br />-- <br />',  '<br />'),
+]
+
+
+def strings_overlap(a, b):
+    """Whether some text can be part of both a and b: one holds the other,
+    or the end of one is the start of the other."""
+    if a in b or b in a:
+        return True
+    for length in range(1, min(len(a), len(b))):
+        if a.endswith(b[:length]) or b.endswith(a[:length]):
+            return True
+    return False
+
+
+def fixups_interact(earlier, later):
+    """Whether applying two (old, new) rules in a single pass could give
+    another result than applying earlier, then later.
+
+    That is when their matches can overlap, or when later can match text
+    that earlier produced, or that came together where earlier deleted
+    something.
+    """
+    return strings_overlap(earlier[0], later[0]) or strings_overlap(earlier[1], later[0])
+
+
+def compile_fixup_pass(rules):
+    """Return a function applying (old, new) rules which never interact."""
+    if len(rules) == 1:
+        (old, new) = rules[0]
+        return lambda html: html.replace(old, new)
+
+    replacements = dict(rules)
+    regexp = re.compile('|'.join(re.escape(old) for (old, new) in rules))
+    return lambda html: regexp.sub(lambda m: replacements[m.group(0)], html)
+
+
+def compile_fixups(rules):
+    """Return a function applying (old, new) replacements one after the other.
+
+    The result is that of chained str.replace() calls in the order of the
+    rules, but consecutive rules which cannot interact are applied
+    together, in a single pass over the HTML.
+    """
+    groups = []
+    for rule in rules:
+        if not groups or any(fixups_interact(earlier, rule) for earlier in groups[-1]):
+            groups.append([])
+        groups[-1].append(rule)
+    passes = [compile_fixup_pass(group) for group in groups]
+
+    def apply_fixups(html):
+        for fixup_pass in passes:
+            html = fixup_pass(html)
+        return html
+    return apply_fixups
+
+
+compiled_fixups = {}
+def get_fixups(rules):
+    """compile_fixups(), only done once for each set of rules."""
+    rules = tuple(rules)
+    if rules not in compiled_fixups:
+        compiled_fixups[rules] = compile_fixups(rules)
+    return compiled_fixups[rules]
+
+
+# Each process reuses the one HTML2Text, reset between entries
+markdown_converter = html2text_module.HTML2Text()
+def html2text(html):
+    markdown_converter.reset()
+    return markdown_converter.handle(html)
 
 
 def extract_filename(permalink):
@@ -236,137 +686,888 @@ def extract_filename(permalink):
     return filename.split('.html')[0] + '.mdwn'
 
 
-def print_post(entry, tags):
-    published_date = get_date(entry, 'published')
-    updated_date = get_date(entry, 'updated')
-
-    author = get_author_name(entry)
-    title = get_title(entry).replace('"', '&quot;')
-    permalink = get_permalink(entry)
-    filename = extract_filename(permalink)
-    content = get_content(entry, filename, False)
-
-    s = '[[!meta title="' + title + '"]]' + "\n"
-    s += '[[!meta date="' + published_date + '"]]' + "\n"
-    s += '[[!meta license="' + LICENSE_LINK + '"]]' + "\n"
-    s += content + "\n"
-    for tag in tags:
-        s += "[[!tag " + tag + "]] "
-    return (filename, s, permalink)
-
+def comment_number(published_date):
+    """Number a comment by when it was published, e.g. 20120103100000.
 
-def print_comment(entry):
-    published_date = get_date(entry, 'published')
-    updated_date = get_date(entry, 'updated')
+    Unlike a running count, this only depends on the comment itself, so
+    its file keeps the same name when other comments come and go.
+    """
+    return re.sub(r'\D', '', published_date[:19])
 
-    author_name = get_author_name(entry)
-    author_uri = get_author_uri(entry)
 
-    permalink = get_permalink(entry)
-    filename = extract_filename(permalink)
-    content = get_content(entry, filename, True)
+def comment_filename(post_filename, entry):
+    directory = post_filename.split('.mdwn')[0]
+    comment_guid = md5(get_id(entry).encode('utf8')).hexdigest()
+    number = comment_number(get_date(entry, 'published'))
+    filename = 'comment_' + number + '_' + comment_guid + '._comment'
+    return directory + '/' + filename
 
-    s = '[[!comment format=mdwn' + "\n"
-    if author_uri:
-        s += ' username="' + author_uri + '"' + "\n"
-        s += ' nickname="' + author_name + '"' + "\n"
-    else:
-        s += ' claimedauthor="' + author_name + '"' + "\n"
-    s += ' subject=""' + "\n"
-    s += ' date="' + published_date + '"' + "\n"
-    s += ' content="""' + "\n"
-    s += content + "\n"
-    s += '"""]]' + "\n"
 
-    return (filename, s)
+def temporary_filename(filename):
+    # ikiwiki ignores dotfiles, should one ever be left behind
+    (directory, name) = os.path.split(filename)
+    return os.path.join(directory, '.' + name + '.tmp')
 
 
-numbers = {}
-def comment_number(post_filename):
-    if post_filename not in numbers:
-        numbers[post_filename] = 0
+def file_holds(filename, data):
+    """Whether filename exists and contains exactly data."""
+    try:
+        if os.path.getsize(filename) != len(data):
+            return False
+    except OSError:
+        return False
 
-    numbers[post_filename] += 1
-    return str(numbers[post_filename])
+    with open(filename, 'rb') as f:
+        return f.read() == data
 
 
 def save_file(filename, contents):
-    with open(filename, 'w') as f:
-        f.write(contents.encode('utf8'))
-    f.close()
-
-
-def save_comment(post_filename, contents):
-    directory = post_filename.split('.mdwn')[0]
-    if not os.path.isdir(directory):
-        os.mkdir(directory)
-
-    comment_guid = md5(contents.encode('utf8')).hexdigest()
-    filename = 'comment_' + comment_number(post_filename) + '_' + comment_guid + '._comment'
-
-    return save_file(directory + '/' + filename, contents)
-
-
-def old_and_new_urls(permalink):
-    components = urlparse(permalink)
-    paths = components.path.split('/')
-    filename = paths[-1]
-    new_url = BLOG_URL + 'posts/' + filename.split('.html')[0] +  '/'
-    return (components.path, new_url)
-
-
-def save_rewrite_rules(filename, rewrite_rules):
-    with open(filename, 'w') as f:
-        f.write("# These rules require that mod_alias be enabled\n\n")
+    """Atomically write contents to filename, unless they are already there.
+
+    Unchanged files keep their mtime, so that ikiwiki only refreshes the
+    pages which really changed.
+    """
+    data = contents.encode('utf8')
+    if file_holds(filename, data):
+        return
+
+    temp_filename = temporary_filename(filename)
+    with open(temp_filename, 'wb') as f:
+        f.write(data)
+    os.rename(temp_filename, filename)
+
+
+def copy_file(source, destination):
+    """Like save_file(), but with the contents of another file."""
+    if os.path.isfile(destination) and filecmp.cmp(source, destination, shallow=False):
+        return
+
+    temp_filename = temporary_filename(destination)
+    shutil.copyfile(source, temp_filename)
+    os.rename(temp_filename, destination)
+
+
+def post_images(post_filename, post):
+    """Return the local image files that a converted post refers to."""
+    image_directory = post_filename.split('.mdwn')[0]
+    prefix = '/posts/' + image_directory + '/'
+    images = re.findall(re.escape(prefix) + r'([^/)]+)\)', post)
+    return [image_directory + '/' + image for image in sorted(set(images))]
+
+
+def load_manifest(filename):
+    """Return the fingerprint and the entries recorded by the previous run.
+
+    The entries are returned whatever the fingerprint, as their files are
+    still on disk and must be removed or replaced.
+    """
+    if os.path.isfile(filename):
+        with open(filename) as f:
+            manifest = json.load(f)
+        return (manifest.get('converter'), manifest['entries'])
+    return (None, {})
+
+
+def save_manifest(filename, fingerprint, entries):
+    manifest = {'converter': fingerprint, 'entries': entries}
+    save_file(filename, unicode(json.dumps(manifest, indent=1, sort_keys=True)))
+
+
+def load_journal(filename):
+    """Return the fingerprint and the records of the entries finished by an
+    interrupted run.
+
+    Like with load_manifest(), the records are returned whatever the
+    fingerprint, as their files were written all the same.
+    """
+    fingerprint = None
+    records = {}
+    if os.path.isfile(filename):
+        with open(filename) as f:
+            lines = f.readlines()
+        if lines:
+            fingerprint = json.loads(lines[0]).get('converter')
+            for line in lines[1:]:
+                try:
+                    (entry_id, record) = json.loads(line)
+                except ValueError:
+                    # Cut short by the interruption
+                    break
+                records[entry_id] = record
+    return (fingerprint, records)
+
+
+def open_journal(filename, fingerprint, resuming):
+    """Open the journal for appending, starting a new one unless resuming."""
+    if resuming:
+        return open(filename, 'a')
+    f = open(filename, 'w')
+    f.write(json.dumps({'converter': fingerprint}) + '\n')
+    return f
+
+
+def manifest_changes(previous_entries, entries):
+    """The files added, modified and deleted between two manifests.
+
+    Pages and comments count as modified when their text changed, and
+    images when they are downloaded from a different URL.
+    """
+    def files(manifest):
+        result = {}
+        for record in manifest.values():
+            images = record.get('images', {})
+            for filename in record['files']:
+                result[filename] = images.get(filename, record['hash'])
+        return result
+
+    old_files = files(previous_entries)
+    new_files = files(entries)
+    added = set(new_files) - set(old_files)
+    deleted = set(old_files) - set(new_files)
+    modified = set(filename for filename in set(new_files) & set(old_files)
+                   if new_files[filename] != old_files[filename])
+    return (added, modified, deleted)
+
+
+def is_unchanged(record, entry, directory):
+    """Whether the outputs recorded for an entry are still current.
+
+    Besides the entry's own update date, where its outputs go must not
+    have moved: the permalink of a post, or the page of a comment, whose
+    post may have been renamed without the comment being updated. A
+    comment must also have been saved under the name it gets nowadays, so
+    that the files of an older naming scheme get replaced.
+    """
+    if not record or record['updated'] != get_date(entry, 'updated'):
+        return False
+    if entry.kind == 'post':
+        if record['permalink'] != get_permalink(entry):
+            return False
+    else:
+        post_filename = extract_filename(get_page_permalink(entry))
+        if record['post'] != post_filename:
+            return False
+        if record['files'] != [comment_filename(post_filename, entry)]:
+            return False
+    for filename in record['files']:
+        if not os.path.isfile(os.path.join(directory, filename)):
+            return False
+    return True
+
+
+def remove_outputs(directory, filenames):
+    """Remove output files and return the subdirectories they were in."""
+    directories = set()
+    for filename in filenames:
+        path = os.path.join(directory, filename)
+        if os.path.isfile(path):
+            os.remove(path)
+        if os.path.dirname(filename):
+            directories.add(os.path.dirname(filename))
+    return directories
+
+
+def remove_empty_directories(directory, subdirectories):
+    for subdirectory in subdirectories:
+        path = os.path.join(directory, subdirectory)
+        if os.path.isdir(path) and not os.listdir(path):
+            os.rmdir(path)
+
+
+def untracked_files(directory, entries):
+    """Return the pages, comments and images found in directory which
+    none of the entries of a manifest produced."""
+    tracked = set()
+    for record in entries.values():
+        tracked.update(record['files'])
+
+    untracked = []
+    for (path, dirnames, filenames) in os.walk(directory):
+        # Dotfiles are the manifest, the journal and unfinished writes
+        dirnames[:] = sorted(name for name in dirnames if not name.startswith('.'))
+        subdirectory = os.path.relpath(path, directory)
+        for name in sorted(filenames):
+            if name.startswith('.'):
+                continue
+            if subdirectory == '.':
+                if name.endswith('.mdwn'):
+                    untracked.append(name)
+            elif name.endswith('._comment') or subdirectory.count(os.sep) == 0:
+                untracked.append(os.path.join(subdirectory, name))
+    return [filename for filename in untracked if filename not in tracked]
+
+
+def iter_entries(filename):
+    """Yield the posts and comments of an Atom export one at a time.
+
+    Each <entry> element is thrown away as soon as its Post or Comment
+    has been read, so memory use is bounded by the largest entry rather
+    than by the size of the whole export. Comments get the permalink of
+    their post when it came earlier in the export.
+    """
+    post_permalinks = {}
+
+    events = ElementTree.iterparse(filename, events=('start', 'end'))
+    (event, feed) = next(events)
+    for (event, element) in events:
+        if event == 'end' and element.tag == ATOM + 'entry':
+            entry = read_entry(element)
+            feed.clear()
+
+            if entry is None:
+                continue
+            if entry.kind == 'post':
+                post_permalinks[entry.id] = get_permalink(entry)
+            else:
+                entry.post_permalink = post_permalinks.get(entry.post_id)
+            yield entry
+
+
+def pending_entries(filename, reusable, directory):
+    """Yield (entry, changed) for the posts and comments of an export.
+
+    changed is False when the outputs recorded in reusable, and found in
+    directory, can be reused as they are.
+    """
+    for entry in iter_entries(filename):
+        previous = reusable.get(get_id(entry))
+        yield (entry, not is_unchanged(previous, entry, directory))
+
+
+# Seconds spent in each stage of the conversion and on each converted
+# entry, only collected with --profile
+stage_times = None
+entry_times = []
+
+# Functions whose time is added up under a stage name with --profile
+PROFILED_FUNCTIONS = [
+    ('Converter.fix_html', 'html_fixups'),
+    ('html2text', 'html2text'),
+    ('post_process', 'post_process'),
+    ('save_file', 'write'),
+    ('ImageDownloader.wait', 'images'),
+]
+
+
+def timed(stage, function):
+    """Wrap function so that the time spent in it is added to stage."""
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stage_times[stage] = stage_times.get(stage, 0) + time.time() - start
+    return wrapper
+
+
+def timed_iterator(stage, iterable):
+    """Yield from iterable, adding the time spent waiting on it to stage."""
+    iterator = iter(iterable)
+    while True:
+        start = time.time()
+        try:
+            item = next(iterator)
+        finally:
+            stage_times[stage] = stage_times.get(stage, 0) + time.time() - start
+        yield item
+
+
+# The profiled functions as they were before enable_profiling()
+unprofiled_functions = {}
+
+
+def enable_profiling():
+    """Start timing the stages of the conversion.
+
+    The profiled functions are only replaced by timed ones from here on,
+    so that nothing is measured, and nothing is paid for, without
+    --profile. Whatever an earlier run measured is dropped.
+    """
+    global stage_times
+    disable_profiling()
+    stage_times = {}
+    del entry_times[:]
+    module = globals()
+    for (name, stage) in PROFILED_FUNCTIONS:
+        if '.' in name:
+            (class_name, method) = name.split('.')
+            # From the class __dict__, as getattr() gives an unbound method
+            function = vars(module[class_name])[method]
+            setattr(module[class_name], method, timed(stage, function))
+        else:
+            function = module[name]
+            module[name] = timed(stage, function)
+        unprofiled_functions[name] = function
+
+
+def disable_profiling():
+    """Put back the functions replaced by enable_profiling()."""
+    global stage_times
+    stage_times = None
+    module = globals()
+    for (name, function) in unprofiled_functions.items():
+        if '.' in name:
+            (class_name, method) = name.split('.')
+            setattr(module[class_name], method, function)
+        else:
+            module[name] = function
+    unprofiled_functions.clear()
 
-        if TAGGED_FEEDS:
-            f.write("# Tagged feeds\n")
-            for tag in TAGGED_FEEDS:
-                old_tag_path = '/feeds/posts/default/-/%s' % tag
-                new_tag_url = BLOG_URL + 'tags/%s/index.rss' % tag
-                f.write("Redirect permanent %s %s\n" % (old_tag_path, new_tag_url))
 
-                old_tag_path = '/search/label/%s' % tag
-                new_tag_url = BLOG_URL + 'tags/%s' % tag
-                f.write("Redirect permanent %s %s\n" % (old_tag_path, new_tag_url))
-            f.write("\n")
+def print_profile(elapsed, slowest):
+    print 'Time per stage (%.2f s in total):' % elapsed
+    for (stage, seconds) in sorted(stage_times.items(), key=lambda item: -item[1]):
+        print '  %-15s %8.2f s' % (stage, seconds)
 
-        f.write("# Articles\n")
-        for rule in rewrite_rules:
-            f.write("Redirect permanent %s %s\n" % (rule[0], rule[1]))
-    f.close()
+    print 'Slowest entries:'
+    entry_times.sort(reverse=True)
+    for (seconds, entry_id, times) in entry_times[:slowest]:
+        stages = ', '.join('%s %.3f' % (stage, times[stage]) for stage in sorted(times))
+        print '  %8.3f s  %s (%s)' % (seconds, entry_id, stages)
 
 
-document = minidom.parse(ATOM_BACKUP_FILENAME)
-feed = document.getElementsByTagName('feed').item(0)
+def convert_entry(task):
+    """Convert the entry of a (converter, entry) task and return its
+    output along with its images.
 
-rewrite_rules = []
-entries = feed.getElementsByTagName('entry')
-for entry in entries:
-    is_post = False
-    is_comment = False
+    This is what runs in the worker processes when there are any.
+    """
+    if task is None:
+        return None
 
-    tags = []
+    (converter, entry) = task
+    del image_requests[:]
+    if entry.kind == 'post':
+        output = converter.print_post(entry)
+    else:
+        output = converter.print_comment(entry)
+    return (output, list(image_requests))
+
+
+def profiled_convert_entry(task):
+    """Like convert_entry, but also return how long the entry took in
+    total and in each stage."""
+    global stage_times
+    if task is None:
+        return None
+
+    (totals, stage_times) = (stage_times, {})
+    start = time.time()
+    try:
+        converted = convert_entry(task)
+        return (converted, time.time() - start, stage_times)
+    finally:
+        stage_times = totals
+
+
+def record_entry_times(entry, result):
+    """Add up the times returned by profiled_convert_entry and return
+    what convert_entry would have."""
+    if result is None:
+        return None
+
+    (converted, seconds, times) = result
+    for (stage, stage_seconds) in times.items():
+        stage_times[stage] = stage_times.get(stage, 0) + stage_seconds
+    entry_times.append((seconds, get_id(entry), times))
+    return converted
+
+
+def converted_entries(entries, converter, pool, jobs):
+    """Yield (entry, converted) in export order.
+
+    converted is None for the entries which did not need converting. With
+    a pool, entries are sent to the worker processes in batches and the
+    next batch is converted while the results of the previous one are
+    being saved. Only the batches in flight are ever held in memory.
+    """
+    convert = convert_entry
+    if stage_times is not None:
+        convert = profiled_convert_entry
+
+    if not pool:
+        for (entry, changed) in entries:
+            converted = changed and convert((converter, entry)) or None
+            if stage_times is not None:
+                converted = record_entry_times(entry, converted)
+            yield (entry, converted)
+        return
+
+    in_flight = None
+    while True:
+        batch = list(itertools.islice(entries, jobs * 16))
+        if batch:
+            tasks = [changed and (converter, entry) or None for (entry, changed) in batch]
+            results = pool.map_async(convert, tasks)
+
+        if in_flight:
+            (previous_batch, previous_results) = in_flight
+            for ((entry, changed), converted) in zip(previous_batch, previous_results.get()):
+                if stage_times is not None:
+                    converted = record_entry_times(entry, converted)
+                yield (entry, converted)
+
+        if not batch:
+            break
+        in_flight = (batch, results)
+
+
+class Converter(object):
+    """The settings of one blog, and the conversion of its export.
+
+    Converters are sent along with the entries to the worker processes,
+    so they only hold plain settings.
+    """
+
+    def __init__(self, export_filename, directory='.', blog_url=None,
+                 aliases_filename=None, license_link=None,
+                 author_url_replacements=None, tagged_feeds=(), html_fixups=()):
+        self.export_filename = export_filename
+        self.directory = directory
+        # Must include the trailing slash
+        if blog_url and not blog_url.endswith('/'):
+            blog_url += '/'
+        self.blog_url = blog_url
+        self.aliases_filename = aliases_filename
+        self.license_link = license_link
+        self.author_url_replacements = dict(author_url_replacements or {})
+        self.tagged_feeds = list(tagged_feeds)
+        # Extra (old, new) replacements applied to the HTML of every post
+        # and comment before conversion, after the built-in HTML_FIXUPS
+        self.html_fixups = list(html_fixups)
+
+    def path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def fingerprint(self):
+        """Hash of the conversion code and settings that shape the output.
+
+        Changing any of them invalidates every entry of an existing manifest.
+        """
+        h = md5()
+        for source_filename in SOURCE_FILENAMES:
+            with open(source_filename) as f:
+                h.update(f.read())
+        h.update(repr((self.license_link, sorted(self.author_url_replacements.items()),
+                       self.html_fixups)))
+        return h.hexdigest()
+
+    def fix_html(self, html, is_comment):
+        if is_comment:
+            return get_fixups(HTML_FIXUPS + COMMENT_HTML_FIXUPS + self.html_fixups)(html)
+        return get_fixups(HTML_FIXUPS + self.html_fixups)(html)
+
+    def get_author_uri(self, entry):
+        url = entry.author_uri
+        if url in self.author_url_replacements:
+            return self.author_url_replacements[url]
+        else:
+            return url
 
-    categories = entry.getElementsByTagName('category')
-    for category in categories:
-        scheme = category.getAttribute('scheme')
-        if scheme == 'http://schemas.google.com/g/2005#kind':
-            term = category.getAttribute('term')
-            if term == 'http://schemas.google.com/blogger/2008/kind#post':
-                is_post = True
-            elif term == 'http://schemas.google.com/blogger/2008/kind#comment':
-                is_comment = True
-        elif scheme == 'http://www.blogger.com/atom/ns#':
-            term = category.getAttribute('term')
-            tags.append(term)
-
-    if is_post:
-        (filename, post, permalink) = print_post(entry, tags)
-        save_file(filename, post)
-        rewrite_rules.append(old_and_new_urls(permalink))
-    elif is_comment:
-        (filename, comment) = print_comment(entry)
-        save_comment(filename, comment)
-
-save_rewrite_rules("apache-aliases.conf", rewrite_rules)
+    def get_content(self, entry, post_filename, is_comment):
+        html = self.fix_html(entry.content, is_comment)
+        text = html2text(html)
+        return post_process(text, post_filename, is_comment)
+
+    def print_post(self, entry):
+        published_date = get_date(entry, 'published')
+        updated_date = get_date(entry, 'updated')
+
+        author = get_author_name(entry)
+        title = get_title(entry).replace('"', '&quot;')
+        permalink = get_permalink(entry)
+        filename = extract_filename(permalink)
+        content = self.get_content(entry, filename, False)
+
+        s = '[[!meta title="' + title + '"]]' + "\n"
+        s += '[[!meta date="' + published_date + '"]]' + "\n"
+        if self.license_link:
+            s += '[[!meta license="' + self.license_link + '"]]' + "\n"
+        s += content + "\n"
+        for tag in get_tags(entry):
+            s += "[[!tag " + tag + "]] "
+        return (filename, s, permalink)
+
+    def print_comment(self, entry):
+        published_date = get_date(entry, 'published')
+        updated_date = get_date(entry, 'updated')
+
+        author_name = get_author_name(entry)
+        author_uri = self.get_author_uri(entry)
+
+        filename = extract_filename(get_page_permalink(entry))
+        content = self.get_content(entry, filename, True)
+
+        s = '[[!comment format=mdwn' + "\n"
+        if author_uri:
+            s += ' username="' + author_uri + '"' + "\n"
+            s += ' nickname="' + author_name + '"' + "\n"
+        else:
+            s += ' claimedauthor="' + author_name + '"' + "\n"
+        s += ' subject=""' + "\n"
+        s += ' date="' + published_date + '"' + "\n"
+        s += ' content="""' + "\n"
+        s += content + "\n"
+        s += '"""]]' + "\n"
+
+        return (filename, s)
+
+    def save_post(self, post_filename, contents):
+        # The post's images and comments go in a directory named after it
+        directory = self.path(post_filename.split('.mdwn')[0])
+        if not os.path.isdir(directory):
+            os.mkdir(directory)
+
+        save_file(self.path(post_filename), contents)
+
+    def save_comment(self, post_filename, entry, contents):
+        filename = comment_filename(post_filename, entry)
+        if not os.path.isdir(self.path(os.path.dirname(filename))):
+            os.mkdir(self.path(os.path.dirname(filename)))
+
+        save_file(self.path(filename), contents)
+        return filename
+
+    def old_and_new_urls(self, permalink):
+        components = urlparse(permalink)
+        paths = components.path.split('/')
+        filename = paths[-1]
+        new_url = self.blog_url + 'posts/' + filename.split('.html')[0] +  '/'
+        return (components.path, new_url)
+
+    def save_rewrite_rules(self, filename, rewrite_rules):
+        with open(filename, 'w') as f:
+            f.write("# These rules require that mod_alias be enabled\n\n")
+
+            if self.tagged_feeds:
+                f.write("# Tagged feeds\n")
+                for tag in self.tagged_feeds:
+                    old_tag_path = '/feeds/posts/default/-/%s' % tag
+                    new_tag_url = self.blog_url + 'tags/%s/index.rss' % tag
+                    f.write("Redirect permanent %s %s\n" % (old_tag_path, new_tag_url))
+
+                    old_tag_path = '/search/label/%s' % tag
+                    new_tag_url = self.blog_url + 'tags/%s' % tag
+                    f.write("Redirect permanent %s %s\n" % (old_tag_path, new_tag_url))
+                f.write("\n")
+
+            f.write("# Articles\n")
+            for rule in rewrite_rules:
+                f.write("Redirect permanent %s %s\n" % (rule[0], rule[1]))
+        f.close()
+
+    def run(self, image_downloader, pool=None, jobs=1, incremental=False, prune=False):
+        """Convert the export into the output directory.
+
+        The images are handed over to image_downloader, which is left for
+        the caller to wait on. With prune, the pages, comments and images
+        of the output directory which no entry produced are deleted too.
+        Returns a dict with the number of entries and of converted ones,
+        along with the files added, modified and deleted since the
+        previous run as recorded in the manifests.
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        # The files of the previous run are always tracked, so that they get
+        # removed when their entry goes, but its outputs are only reused when
+        # they were made by the same code and settings
+        manifest_filename = self.path(MANIFEST_FILENAME)
+        fingerprint = self.fingerprint()
+        (previous_fingerprint, previous_manifest) = load_manifest(manifest_filename)
+        reusable = {}
+        if incremental and previous_fingerprint == fingerprint:
+            reusable = dict(previous_manifest)
+
+        # Entries finished by an interrupted run are not converted again
+        journal_filename = self.path(JOURNAL_FILENAME)
+        (journal_fingerprint, finished) = load_journal(journal_filename)
+        previous_manifest.update(finished)
+        resuming = bool(finished) and journal_fingerprint == fingerprint
+        if resuming:
+            reusable.update(finished)
+        journal = open_journal(journal_filename, fingerprint, resuming)
+
+        manifest = {}
+        converted_count = 0
+        emptied_directories = set()
+
+        rewrite_rules = []
+        entries = pending_entries(self.export_filename, reusable, self.directory)
+        if stage_times is not None:
+            entries = timed_iterator('parse', entries)
+        for (entry, converted) in converted_entries(entries, self, pool, jobs):
+            entry_id = get_id(entry)
+            updated_date = get_date(entry, 'updated')
+            previous = previous_manifest.get(entry_id)
+            if converted:
+                converted_count += 1
+
+            if entry.kind == 'post':
+                if not converted:
+                    record = previous
+                else:
+                    ((filename, post, permalink), images) = converted
+                    self.save_post(filename, post)
+                    record = {'updated': updated_date, 'permalink': permalink,
+                              'hash': md5(post.encode('utf8')).hexdigest(),
+                              'files': [filename] + post_images(filename, post),
+                              'images': dict((destination, image_url)
+                                             for (image_url, destination) in images)}
+                    for (image_url, destination) in images:
+                        image_downloader.fetch(image_url, self.path(destination))
+                if self.blog_url:
+                    rewrite_rules.append(self.old_and_new_urls(record['permalink']))
+
+                # Only the metadata is kept around for the comments
+                entry.content = None
+            else:
+                if not converted:
+                    record = previous
+                else:
+                    ((post_filename, comment), images) = converted
+                    filename = self.save_comment(post_filename, entry, comment)
+                    record = {'updated': updated_date, 'post': post_filename,
+                              'hash': md5(comment.encode('utf8')).hexdigest(),
+                              'files': [filename]}
+
+            if previous and previous is not record:
+                emptied_directories.update(remove_outputs(
+                    self.directory, set(previous['files']) - set(record['files'])))
+            manifest[entry_id] = record
+            if converted:
+                journal.write(json.dumps([entry_id, record]) + '\n')
+                journal.flush()
+
+        # Entries which have disappeared from the export
+        for entry_id in set(previous_manifest) - set(manifest):
+            emptied_directories.update(remove_outputs(
+                self.directory, previous_manifest[entry_id]['files']))
+
+        # Files which came from elsewhere, such as an older conversion
+        # copied over without a manifest
+        untracked = []
+        if prune:
+            untracked = untracked_files(self.directory, manifest)
+            emptied_directories.update(remove_outputs(self.directory, untracked))
+
+        # The directories of the posts still in the export stay, even when
+        # empty for now, as their new images may still be downloading
+        post_directories = set(record['files'][0].split('.mdwn')[0]
+                               for record in manifest.values() if 'permalink' in record)
+        remove_empty_directories(self.directory, emptied_directories - post_directories)
+
+        if self.blog_url and self.aliases_filename:
+            self.save_rewrite_rules(self.aliases_filename, rewrite_rules)
+        save_manifest(manifest_filename, fingerprint, manifest)
+        journal.close()
+        os.remove(journal_filename)
+
+        (added, modified, deleted) = manifest_changes(previous_manifest, manifest)
+        deleted.update(untracked)
+        return {'entries': len(manifest), 'converted': converted_count,
+                'added': added, 'modified': modified, 'deleted': deleted}
+
+
+def parse_replacement(option, opt_str, value, parser):
+    """optparse callback turning OLD=NEW into an (old, new) pair."""
+    if '=' not in value:
+        raise optparse.OptionValueError('%s expects OLD=NEW, not %r' % (opt_str, value))
+    # A new list, as the default one is shared by every parse_args()
+    setattr(parser.values, option.dest,
+            getattr(parser.values, option.dest) + [tuple(value.split('=', 1))])
+
+
+def read_batch(filename):
+    """Return the command lines of the blogs listed in a batch file.
+
+    Each line holds the export and per-blog options of one blog, quoted
+    as in a shell. Blank lines and # comments are skipped.
+    """
+    blogs = []
+    with open(filename) as f:
+        for line in f:
+            arguments = shlex.split(line, comments=True)
+            if arguments:
+                blogs.append(arguments)
+    return blogs
+
+
+# With --batch, the options which only apply to the whole run, and those
+# which only apply to a single blog and go on the lines of the batch file
+GLOBAL_OPTIONS = ['jobs', 'profile', 'profile_dump', 'batch']
+BLOG_OPTIONS = ['blog_url', 'aliases', 'tagged_feeds', 'license_link', 'author_urls',
+                'html_fixups', 'output', 'sync']
+
+
+def given_options(parser, options, dests):
+    """Return the names of the options among dests set to something else
+    than their default."""
+    return [option.get_opt_string() for option in parser.option_list
+            if option.dest in dests
+            and getattr(options, option.dest) != parser.defaults.get(option.dest)]
+
+
+def blog_converter(parser, options, args):
+    """Return the Converter for one blog's options and arguments, whether
+    it should be converted incrementally and whether to prune untracked
+    files."""
+    if len(args) != 1:
+        parser.error("expected the Blogger export file")
+
+    if options.sync:
+        # Without a manifest, whatever is there came from somewhere else,
+        # likely from copying an older conversion whose comments are named
+        # differently, and would stay around next to the new files
+        if (not options.prune and
+                not os.path.isfile(os.path.join(options.sync, MANIFEST_FILENAME))):
+            # The files of an interrupted first sync are in its journal
+            (fingerprint, finished) = load_journal(os.path.join(options.sync, JOURNAL_FILENAME))
+            untracked = untracked_files(options.sync, finished)
+            if untracked:
+                parser.error("%s has no manifest but already holds %d pages, comments "
+                             "or images (%s...), use --prune to delete those which "
+                             "are not in the export" % (options.sync, len(untracked),
+                                                       ', '.join(untracked[:3])))
+        options.output = options.sync
+        options.incremental = True
+    tagged_feeds = [tag for tag in options.tagged_feeds.split(',') if tag]
+    converter = Converter(args[0], options.output, options.blog_url, options.aliases,
+                          options.license_link, dict(options.author_urls), tagged_feeds,
+                          options.html_fixups)
+    return (converter, options.incremental, options.prune)
+
+
+def print_result(label, result):
+    print '%s: %d entries, %d converted in %.2f s; %d added, %d modified, %d deleted' % (
+        label, result['entries'], result['converted'], result['time'],
+        len(result['added']), len(result['modified']), len(result['deleted']))
+
+
+def main():
+    parser = optparse.OptionParser('%prog [options] EXPORT\n       %prog [options] --batch FILE')
+    parser.add_option("-u", "--blog-url", dest="blog_url", metavar="URL",
+        help="URL of the blog on ikiwiki, needed for the Apache aliases")
+    parser.add_option("-a", "--aliases", dest="aliases", metavar="FILE",
+        default="apache-aliases.conf",
+        help="where to write the Apache aliases of the old URLs [default: %default]")
+    parser.add_option("-t", "--tagged-feeds", dest="tagged_feeds", metavar="TAGS",
+        default="", help="comma-separated tags whose feeds get an alias too")
+    parser.add_option("-l", "--license", dest="license_link", metavar="LINK",
+        help="Markdown link to the license of the posts")
+    parser.add_option("--author-url", dest="author_urls", metavar="OLD=NEW", default=[],
+        type="string", action="callback", callback=parse_replacement,
+        help="link comments by the author of profile OLD to NEW instead (repeatable)")
+    parser.add_option("--html-fixup", dest="html_fixups", metavar="OLD=NEW", default=[],
+        type="string", action="callback", callback=parse_replacement,
+        help="replace OLD by NEW in the HTML of every entry (repeatable)")
+    parser.add_option("-o", "--output", dest="output", metavar="DIR", default=".",
+        help="directory to write the pages and images into [default: %default]")
+    parser.add_option("-i", "--incremental", action="store_true", dest="incremental",
+        default=False, help="only reconvert entries updated since the last run")
+    parser.add_option("-j", "--jobs", type="int", dest="jobs", default=1,
+        help="number of processes converting entries in parallel")
+    parser.add_option("-s", "--sync", dest="sync", metavar="DIR",
+        help="update the posts/ directory of an ikiwiki srcdir in place (implies -i)")
+    parser.add_option("--prune", action="store_true", dest="prune", default=False,
+        help="delete the pages, comments and images of the output directory which "
+             "are not in the export, such as those of an older conversion")
+    parser.add_option("-p", "--profile", action="store_true", dest="profile", default=False,
+        help="report the time spent in each stage and on the slowest entries")
+    parser.add_option("--profile-dump", dest="profile_dump", metavar="FILE",
+        help="save cProfile statistics of the main process to FILE (implies -p)")
+    parser.add_option("-b", "--batch", dest="batch", metavar="FILE",
+        help="convert each blog listed in FILE, one line of export and per-blog options "
+             "per blog, sharing the worker processes and image downloads; each blog "
+             "with a --blog-url needs its own --aliases")
+    (options, args) = parser.parse_args()
+
+    if options.batch:
+        if args:
+            parser.error("--batch takes the exports from its file")
+        misplaced = given_options(parser, options, BLOG_OPTIONS)
+        if misplaced:
+            parser.error("options of a single blog go on its line of the batch file: %s"
+                         % ', '.join(misplaced))
+
+        blogs = []
+        aliases = {}
+        for arguments in read_batch(options.batch):
+            (blog_options, blog_args) = parser.parse_args(arguments)
+            misplaced = given_options(parser, blog_options, GLOBAL_OPTIONS)
+            if misplaced:
+                parser.error("options of the whole run cannot go in the batch file: %s"
+                             % ', '.join(misplaced))
+            (converter, incremental, prune) = blog_converter(parser, blog_options, blog_args)
+
+            if converter.blog_url:
+                aliases_path = os.path.abspath(converter.aliases_filename)
+                if aliases_path in aliases:
+                    parser.error("%s and %s would both write their Apache aliases to %s, "
+                                 "give each blog its own --aliases"
+                                 % (aliases[aliases_path], converter.export_filename,
+                                    converter.aliases_filename))
+                aliases[aliases_path] = converter.export_filename
+            blogs.append((converter, incremental or options.incremental,
+                          prune or options.prune))
+    else:
+        blogs = [blog_converter(parser, options, args)]
+
+    start_time = time.time()
+    if options.profile or options.profile_dump:
+        enable_profiling()
+    if options.profile_dump:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    # Fork the workers before the downloader starts any threads
+    pool = None
+    if options.jobs > 1:
+        pool = multiprocessing.Pool(options.jobs)
+
+    image_cache = ImageCache(IMAGE_CACHE_DIRECTORY, IMAGE_CACHE_SIZE)
+    image_downloader = ImageDownloader(IMAGE_DOWNLOAD_THREADS, IMAGE_DOWNLOADS_PER_HOST,
+                                       IMAGE_DOWNLOAD_ATTEMPTS, IMAGE_RETRY_ROUNDS, image_cache)
+
+    results = []
+    try:
+        for (converter, incremental, prune) in blogs:
+            blog_start_time = time.time()
+            result = converter.run(image_downloader, pool, options.jobs, incremental, prune)
+            result['time'] = time.time() - blog_start_time
+            results.append(result)
+        if pool:
+            pool.close()
+            pool.join()
+
+        failed_images = image_downloader.wait()
+    finally:
+        # The images downloaded so far are still of use to the next run,
+        # even when this one dies while waiting on the others
+        image_cache.save()
+
+    if options.profile_dump:
+        profiler.disable()
+        profiler.dump_stats(options.profile_dump)
+    if stage_times is not None:
+        print_profile(time.time() - start_time, PROFILE_SLOWEST_ENTRIES)
+        disable_profiling()
+    if options.batch:
+        for ((converter, incremental, prune), result) in zip(blogs, results):
+            print_result(converter.export_filename, result)
+        elapsed = time.time() - start_time
+        entries = sum(result['entries'] for result in results)
+        print 'Converted %d blogs, %d entries in %.2f s (%.1f entries/s)' % (
+            len(blogs), entries, elapsed, entries / max(elapsed, 0.001))
+    elif options.sync:
+        print_result(options.sync, results[0])
+
+    for (url, error) in failed_images:
+        print 'ERROR: could not download %s: %s' % (url, error)
+    if failed_images:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
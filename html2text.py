@@ -58,6 +58,10 @@ IGNORE_ANCHORS = False
 IGNORE_IMAGES = False
 IGNORE_EMPHASIS = False
 
+# Convert HTML made only of text, entities, links, line breaks and emphasis
+# without going through the full HTMLParser
+FAST_PATH = True
+
 ### Entity Nonsense ###
 
 def name2cp(k):
@@ -84,8 +88,62 @@ unifiable_n = {}
 for k in unifiable.keys():
     unifiable_n[name2cp(k)] = unifiable[k]
 
+# Non-breaking spaces are kept, through a placeholder in Google Docs
+del unifiable_n[name2cp('nbsp')]
+unifiable['nbsp'] = '&nbsp_place_holder;'
+
+def cp2text(cp):
+    try:
+        return unichr(cp)
+    except NameError: #Python3
+        return chr(cp)
+
+def entity_table(unicode_snob):
+    """Map every entity name and code point to the text replacing it.
+
+    Without unicode_snob, the ASCII look-alikes of unifiable and
+    unifiable_n are used wherever there is one.
+    """
+    table = {}
+    for name in list(htmlentitydefs.name2codepoint.keys()) + ['apos']:
+        cp = name2cp(name)
+        table[name] = table[cp] = cp2text(cp)
+    if not unicode_snob:
+        table.update(unifiable)
+        table.update(unifiable_n)
+    return table
+
+unified_entities = entity_table(False)
+snob_entities = entity_table(True)
+
 ### End Entity Nonsense ###
 
+whitespace_matcher = re.compile(r'\s+')
+
+# The pieces of HTML which the fast path knows about: text, a few tags with
+# quoted attributes, and complete character or entity references
+simple_token = re.compile(r'''
+      ([^<&]+)
+    | <(a|b|i|u|em|strong|br)((?:\s+[a-zA-Z_:][-a-zA-Z0-9_:.]*\s*=\s*(?:"[^"<]*"|'[^'<]*'))*)\s*(/?)>
+    | </(a|b|i|u|em|strong|br)\s*>
+    | &(\#[0-9]+|\#[xX][0-9a-fA-F]+|[a-zA-Z][a-zA-Z0-9]*);
+''', re.I | re.X)
+simple_attribute = re.compile(r'''\s+([a-zA-Z_:][-a-zA-Z0-9_:.]*)\s*=\s*("[^"<]*"|'[^'<]*')''')
+
+def simple_tokens(data):
+    """Split data into simple_token matches, or return None if some of it
+    needs the full parser."""
+    tokens = []
+    match = simple_token.match
+    pos = 0
+    end = len(data)
+    while pos < end:
+        m = match(data, pos)
+        if m is None: return None
+        tokens.append(m)
+        pos = m.end()
+    return tokens
+
 def onlywhite(line):
     """Return true if the line does only consist of whitespace characters."""
     for c in line:
@@ -93,12 +151,14 @@ def onlywhite(line):
             return c is ' '
     return line
 
+heading_levels = dict(('h%d' % n, n) for n in range(1, 10))
+
 def hn(tag):
-    if tag[0] == 'h' and len(tag) == 2:
-        try:
-            n = int(tag[1])
-            if n in range(1, 10): return n
-        except ValueError: return 0
+    return heading_levels.get(tag, 0)
+
+def link_key(attrs):
+    """Key under which a link is found again by HTML2Text.previousIndex()"""
+    return (attrs['href'], has_key(attrs, 'title'), attrs.get('title'))
 
 def dumb_property_dict(style):
     """returns a hash of css attributes"""
@@ -176,8 +236,6 @@ def list_numbering_start(attrs):
 
 class HTML2Text(HTMLParser.HTMLParser):
     def __init__(self, out=None, baseurl=''):
-        HTMLParser.HTMLParser.__init__(self)
-
         # Config options
         self.unicode_snob = UNICODE_SNOB
         self.links_each_paragraph = LINKS_EACH_PARAGRAPH
@@ -190,9 +248,20 @@ class HTML2Text(HTMLParser.HTMLParser):
         self.ignore_emphasis = IGNORE_EMPHASIS
         self.google_doc = False
         self.ul_item_mark = '*'
+        self.fast_path = FAST_PATH
+        self.baseurl = baseurl
 
         if out is None: self.out = self.outtextf
         else: self.out = out
+
+        # Calls reset() to set up the per-document state
+        HTMLParser.HTMLParser.__init__(self)
+
+    def reset(self):
+        """Forget the current document, but not the options, so that the
+        same converter can be used again for the next one."""
+        HTMLParser.HTMLParser.reset(self)
+
         self.outtextlist = [] # empty list to store output characters before they are "joined"
         try:
             self.outtext = unicode()
@@ -204,10 +273,12 @@ class HTML2Text(HTMLParser.HTMLParser):
         self.start = 1
         self.space = 0
         self.a = []
+        self.a_index = {} # position in self.a of each link, by link_key()
         self.astack = []
         self.acount = 0
         self.list = []
         self.blockquote = 0
+        self.update_prefix()
         self.pre = 0
         self.table = 0
         self.startpre = 0
@@ -229,32 +300,83 @@ class HTML2Text(HTMLParser.HTMLParser):
         self.abbr_title = None # current abbreviation definition
         self.abbr_data = None # last inner HTML (for abbr being defined)
         self.abbr_list = {} # stack of abbreviations to write later
-        self.baseurl = baseurl
-
-        try: del unifiable_n[name2cp('nbsp')]
-        except KeyError: pass
-        unifiable['nbsp'] = '&nbsp_place_holder;'
-
 
     def feed(self, data):
         data = data.replace("</' + 'script>", "</ignore>")
-        HTMLParser.HTMLParser.feed(self, data)
+
+        tokens = None
+        if self.fast_path and not self.google_doc and not self.rawdata and not self.cdata_elem:
+            tokens = simple_tokens(data)
+        if tokens is None:
+            HTMLParser.HTMLParser.feed(self, data)
+        else:
+            self.handle_tokens(tokens)
+
+    def handle_tokens(self, tokens):
+        """Call the same handlers as HTMLParser would for simple_tokens()."""
+        for token in tokens:
+            (text, tag, attrs, empty, endtag, ref) = token.groups()
+            if text is not None:
+                self.handle_data(text)
+            elif tag is not None:
+                tag = tag.lower()
+                attrs = [(name.lower(), value[1:-1] and self.unescape(value[1:-1]))
+                         for (name, value) in simple_attribute.findall(attrs)]
+                self.handle_starttag(tag, attrs)
+                if empty:
+                    self.handle_endtag(tag)
+            elif endtag is not None:
+                self.handle_endtag(endtag.lower())
+            elif ref[0] == '#':
+                self.handle_charref(ref[1:])
+            else:
+                self.handle_entityref(ref)
 
     def handle(self, data):
-        self.feed(data)
+        return self.outtext.join(self.stream([data]))
+
+    def stream(self, chunks):
+        """Generate the text for the given chunks of HTML, line by line.
+
+        Each line, newline included, is given out as soon as it is final,
+        so that the start of a document can be used before the rest of it
+        has even been fed in.
+        """
+        lines = split_lines(self.output_chunks(chunks), self.outtext)
+        if self.google_doc:
+            lines = (line.replace('&nbsp_place_holder;', ' ') for line in lines)
+        if self.body_width:
+            return self.wrap_lines(lines)
+        return terminate_lines(lines)
+
+    def output_chunks(self, chunks):
+        """Feed the chunks of HTML, generating the output of each in turn."""
+        for chunk in chunks:
+            self.feed(chunk)
+            if self.outtextlist:
+                (output, self.outtextlist) = (self.outtextlist, [])
+                for piece in output:
+                    yield piece
         self.feed("")
-        return self.optwrap(self.close())
+        self.finish()
+        for piece in self.outtextlist:
+            yield piece
+        self.outtextlist = []
 
     def outtextf(self, s):
         self.outtextlist.append(s)
         if s: self.lastWasNL = s[-1] == '\n'
 
-    def close(self):
+    def finish(self):
+        """Flush the parser and the pending output, without joining it."""
         HTMLParser.HTMLParser.close(self)
 
         self.pbr()
         self.o('', 0, 'end')
 
+    def close(self):
+        self.finish()
+
         self.outtext = self.outtext.join(self.outtextlist)
 
         if self.google_doc:
@@ -282,20 +404,7 @@ class HTML2Text(HTMLParser.HTMLParser):
         """
         if not has_key(attrs, 'href'): return None
 
-        i = -1
-        for a in self.a:
-            i += 1
-            match = 0
-
-            if has_key(a, 'href') and a['href'] == attrs['href']:
-                if has_key(a, 'title') or has_key(attrs, 'title'):
-                        if (has_key(a, 'title') and has_key(attrs, 'title') and
-                            a['title'] == attrs['title']):
-                            match = True
-                else:
-                    match = True
-
-            if match: return i
+        return self.a_index.get(link_key(attrs))
 
     def drop_last(self, nLetters):
         if not self.quiet:
@@ -365,12 +474,18 @@ class HTML2Text(HTMLParser.HTMLParser):
                 self.quiet -= 1
 
     def handle_tag(self, tag, attrs, start):
+        (handler, before_emphasis) = self.tag_handlers.get(tag, (None, False))
+        if handler is None and not self.google_doc:
+            self.lastWasList = False
+            return
+
         #attrs = fixattrs(attrs)
         if attrs is None:
             attrs = {}
         else:
             attrs = dict(attrs)
 
+        tag_style = parent_style = None
         if self.google_doc:
             # the attrs parameter is empty for a closing tag. in addition, we
             # need the attributes of the parent nodes in order to get a
@@ -387,158 +502,190 @@ class HTML2Text(HTMLParser.HTMLParser):
                 if self.tag_stack:
                     parent_style = self.tag_stack[-1][2]
 
-        if hn(tag):
-            self.p()
-            if start:
-                self.inheader = True
-                self.o(hn(tag)*"#" + ' ')
-            else:
-                self.inheader = False
-                return # prevent redundant emphasis marks on headers
+        if before_emphasis:
+            if handler(self, tag, attrs, start, tag_style):
+                return
 
-        if tag in ['p', 'div']:
-            if self.google_doc:
-                if start and google_has_height(tag_style):
-                    self.p()
-                else:
-                    self.soft_br()
-            else:
+        if self.google_doc:
+            if not self.inheader:
+                # handle some font attributes, but leave headers clean
+                self.handle_emphasis(start, tag_style, parent_style)
+
+        if handler is not None and not before_emphasis:
+            handler(self, tag, attrs, start, tag_style)
+
+        if tag != 'ol' and tag != 'ul':
+            self.lastWasList = False
+
+    # Handlers for handle_tag(), registered in tag_handlers below. They are
+    # called with the tag, its attributes as a dict (those of the opening tag
+    # when google_doc is set), start and the Google Docs style of the tag, and
+    # a true return value ends the handling of the tag.
+
+    def tag_heading(self, tag, attrs, start, tag_style):
+        self.p()
+        if start:
+            self.inheader = True
+            self.o(hn(tag)*"#" + ' ')
+        else:
+            self.inheader = False
+            return True # prevent redundant emphasis marks on headers
+
+    def tag_paragraph(self, tag, attrs, start, tag_style):
+        if self.google_doc:
+            if start and google_has_height(tag_style):
                 self.p()
+            else:
+                self.soft_br()
+        else:
+            self.p()
 
-        if tag == "br" and start: self.o("  \n")
+    def tag_br(self, tag, attrs, start, tag_style):
+        if start: self.o("  \n")
 
-        if tag == "hr" and start:
+    def tag_hr(self, tag, attrs, start, tag_style):
+        if start:
             self.p()
             self.o("* * *")
             self.p()
 
-        if tag in ["head", "style", 'script']:
-            if start: self.quiet += 1
-            else: self.quiet -= 1
+    def tag_quiet(self, tag, attrs, start, tag_style):
+        if start: self.quiet += 1
+        else: self.quiet -= 1
 
         if tag == "style":
             if start: self.style += 1
             else: self.style -= 1
 
-        if tag in ["body"]:
-            self.quiet = 0 # sites like 9rules.com never close <head>
+    def tag_body(self, tag, attrs, start, tag_style):
+        self.quiet = 0 # sites like 9rules.com never close <head>
 
-        if tag == "blockquote":
-            if start:
-                self.p(); self.o('> ', 0, 1); self.start = 1
-                self.blockquote += 1
-            else:
-                self.blockquote -= 1
-                self.p()
+    def tag_blockquote(self, tag, attrs, start, tag_style):
+        if start:
+            self.p(); self.o('> ', 0, 1); self.start = 1
+            self.blockquote += 1
+            self.update_prefix()
+        else:
+            self.blockquote -= 1
+            self.update_prefix()
+            self.p()
 
-        if tag in ['em', 'i', 'u'] and not self.ignore_emphasis:
-            if self.pre or self.in_code or self.in_tt:
-                if self.pre:
-                    self.tags_in_pre = 1
-                elif self.in_code:
-                    self.tags_in_code = 1
-                elif self.in_tt:
-                    self.tags_in_tt = 1
-
-                if start:
-                    self.o("<i>")
-                else:
-                    self.o("</i>")
-            else:
-                self.o("_")
+    def tag_italic(self, tag, attrs, start, tag_style):
+        if self.ignore_emphasis:
+            return
+        if self.pre or self.in_code or self.in_tt:
+            if self.pre:
+                self.tags_in_pre = 1
+            elif self.in_code:
+                self.tags_in_code = 1
+            elif self.in_tt:
+                self.tags_in_tt = 1
 
-        if tag in ['strong', 'b'] and not self.ignore_emphasis:
-            if self.pre or self.in_code or self.in_tt:
-                if self.pre:
-                    self.tags_in_pre = 1
-                elif self.in_code:
-                    self.tags_in_code = 1
-                elif self.in_tt:
-                    self.tags_in_tt = 1
-
-                if start:
-                    self.o("<b>")
-                else:
-                    self.o("</b>")
+            if start:
+                self.o("<i>")
             else:
-                self.o("**")
+                self.o("</i>")
+        else:
+            self.o("_")
+
+    def tag_bold(self, tag, attrs, start, tag_style):
+        if self.ignore_emphasis:
+            return
+        if self.pre or self.in_code or self.in_tt:
+            if self.pre:
+                self.tags_in_pre = 1
+            elif self.in_code:
+                self.tags_in_code = 1
+            elif self.in_tt:
+                self.tags_in_tt = 1
 
-        if tag in ['del', 'strike', 's']:
             if start:
-                self.o("<"+tag+">")
+                self.o("<b>")
             else:
-                self.o("</"+tag+">")
+                self.o("</b>")
+        else:
+            self.o("**")
 
-        if self.google_doc:
-            if not self.inheader:
-                # handle some font attributes, but leave headers clean
-                self.handle_emphasis(start, tag_style, parent_style)
+    def tag_strikethrough(self, tag, attrs, start, tag_style):
+        if start:
+            self.o("<"+tag+">")
+        else:
+            self.o("</"+tag+">")
 
-        #TODO: `` `this` ``
-        if tag == 'tt' and not self.pre:
-            if start:
-                self.in_tt = True
-                self.o('<!-- START TT -->')
+    #TODO: `` `this` ``
+    def tag_tt(self, tag, attrs, start, tag_style):
+        if self.pre:
+            return
+        if start:
+            self.in_tt = True
+            self.o('<!-- START TT -->')
+        else:
+            if self.tags_in_tt:
+                self.o('<!-- END TT WITH TAGS -->')
             else:
-                if self.tags_in_tt:
-                    self.o('<!-- END TT WITH TAGS -->')
-                else:
-                    self.o('<!-- END TT WITHOUT TAGS -->')
-                self.in_tt = False
-                self.tags_in_tt = False
-        if tag == 'code' and not self.pre:
-            if start:
-                self.in_code = True
-                self.o('<!-- START CODE -->')
+                self.o('<!-- END TT WITHOUT TAGS -->')
+            self.in_tt = False
+            self.tags_in_tt = False
+
+    def tag_code(self, tag, attrs, start, tag_style):
+        if self.pre:
+            return
+        if start:
+            self.in_code = True
+            self.o('<!-- START CODE -->')
+        else:
+            if self.tags_in_code:
+                self.o('<!-- END CODE WITH TAGS -->')
             else:
-                if self.tags_in_code:
-                    self.o('<!-- END CODE WITH TAGS -->')
-                else:
-                    self.o('<!-- END CODE WITHOUT TAGS -->')
-                self.in_code = False
-                self.tags_in_code = False
+                self.o('<!-- END CODE WITHOUT TAGS -->')
+            self.in_code = False
+            self.tags_in_code = False
 
-        if tag == "abbr":
-            if start:
+    def tag_abbr(self, tag, attrs, start, tag_style):
+        if start:
+            self.abbr_title = None
+            self.abbr_data = ''
+            if has_key(attrs, 'title'):
+                self.abbr_title = attrs['title']
+        else:
+            if self.abbr_title != None:
+                self.abbr_list[self.abbr_data] = self.abbr_title
                 self.abbr_title = None
-                self.abbr_data = ''
-                if has_key(attrs, 'title'):
-                    self.abbr_title = attrs['title']
+            self.abbr_data = ''
+
+    def tag_a(self, tag, attrs, start, tag_style):
+        if self.ignore_links:
+            return
+        if self.table and start:
+            self.o('<a href="' + attrs['href'] + '">')
+        elif self.table:
+            self.o("</a>")
+        elif start:
+            if has_key(attrs, 'href') and not (self.skip_internal_links and attrs['href'].startswith('#')):
+                self.astack.append(attrs)
+                self.o("[")
             else:
-                if self.abbr_title != None:
-                    self.abbr_list[self.abbr_data] = self.abbr_title
-                    self.abbr_title = None
-                self.abbr_data = ''
-
-        if tag == "a" and not self.ignore_links:
-            if self.table and start:
-                self.o('<a href="' + attrs['href'] + '">')
-            elif self.table:
-                self.o("</a>")
-            elif start:
-                if has_key(attrs, 'href') and not (self.skip_internal_links and attrs['href'].startswith('#')):
-                    self.astack.append(attrs)
-                    self.o("[")
-                else:
-                    self.astack.append(None)
-            else:
-                if self.astack:
-                    a = self.astack.pop()
-                    if a:
-                        if self.inline_links:
-                            self.o("](" + a['href'] + ")")
+                self.astack.append(None)
+        else:
+            if self.astack:
+                a = self.astack.pop()
+                if a:
+                    if self.inline_links:
+                        self.o("](" + a['href'] + ")")
+                    else:
+                        i = self.previousIndex(a)
+                        if i is not None:
+                            a = self.a[i]
                         else:
-                            i = self.previousIndex(a)
-                            if i is not None:
-                                a = self.a[i]
-                            else:
-                                self.acount += 1
-                                a['count'] = self.acount
-                                a['outcount'] = self.outcount
-                                self.a.append(a)
-                            self.o("][" + str(a['count']) + "]")
-
-        if tag == "img" and start and not self.ignore_images:
+                            self.acount += 1
+                            a['count'] = self.acount
+                            a['outcount'] = self.outcount
+                            self.a_index[link_key(a)] = len(self.a)
+                            self.a.append(a)
+                        self.o("][" + str(a['count']) + "]")
+
+    def tag_img(self, tag, attrs, start, tag_style):
+        if start and not self.ignore_images:
             if has_key(attrs, 'src'):
                 attrs['href'] = attrs['src']
                 alt = attrs.get('alt', '')
@@ -554,90 +701,125 @@ class HTML2Text(HTMLParser.HTMLParser):
                         self.acount += 1
                         attrs['count'] = self.acount
                         attrs['outcount'] = self.outcount
+                        self.a_index[link_key(attrs)] = len(self.a)
                         self.a.append(attrs)
                     self.o("![")
                     self.o(alt)
                     self.o("]["+ str(attrs['count']) +"]")
 
-        if tag == 'dl' and start: self.p()
-        if tag == 'dt' and not start: self.pbr()
-        if tag == 'dd' and start: self.o('    ')
-        if tag == 'dd' and not start: self.pbr()
+    def tag_dl(self, tag, attrs, start, tag_style):
+        if start: self.p()
 
-        if tag in ["ol", "ul"]:
-            # Google Docs create sub lists as top level lists
-            if (not self.list) and (not self.lastWasList):
-                self.p()
-            if start:
-                if self.google_doc:
-                    list_style = google_list_style(tag_style)
-                else:
-                    list_style = tag
-                numbering_start = list_numbering_start(attrs)
-                self.p()
-                self.list.append({'name':list_style, 'num':numbering_start})
+    def tag_dt(self, tag, attrs, start, tag_style):
+        if not start: self.pbr()
+
+    def tag_dd(self, tag, attrs, start, tag_style):
+        if start: self.o('    ')
+        else: self.pbr()
+
+    def tag_list(self, tag, attrs, start, tag_style):
+        # Google Docs create sub lists as top level lists
+        if (not self.list) and (not self.lastWasList):
+            self.p()
+        if start:
+            if self.google_doc:
+                list_style = google_list_style(tag_style)
             else:
-                if self.list:
-                    self.list.pop()
-                    self.p()
-            self.lastWasList = True
+                list_style = tag
+            numbering_start = list_numbering_start(attrs)
+            self.p()
+            self.list.append({'name':list_style, 'num':numbering_start})
+            self.update_prefix()
         else:
-            self.lastWasList = False
+            if self.list:
+                self.list.pop()
+                self.update_prefix()
+                self.p()
+        self.lastWasList = True
 
-        if tag == 'li':
-            self.pbr()
-            if start:
-                if self.list: li = self.list[-1]
-                else: li = {'name':'ul', 'num':0}
-                if self.google_doc:
-                    nest_count = self.google_nest_count(tag_style)
-                else:
-                    nest_count = len(self.list)
-
-                fudge_factor = 0
-                if li['num'] >= 9:
-                    fudge_factor += 1
-                if li['num'] >= 99:
-                    fudge_factor += 1
-                self.o(" " * (2*nest_count - fudge_factor))
-
-                if li['name'] == "ul": self.o(self.ul_item_mark + " ")
-                elif li['name'] == "ol":
-                    li['num'] += 1
-                    self.o(str(li['num'])+". ")
-                self.start = 1
-
-        if tag == 'table':
-            if start:
-                self.table = 1
-                self.o("<"+tag+">")
+    def tag_li(self, tag, attrs, start, tag_style):
+        self.pbr()
+        if start:
+            if self.list: li = self.list[-1]
+            else: li = {'name':'ul', 'num':0}
+            if self.google_doc:
+                nest_count = self.google_nest_count(tag_style)
             else:
-                self.table = 0
-                self.o("</"+tag+">")
+                nest_count = len(self.list)
+
+            fudge_factor = 0
+            if li['num'] >= 9:
+                fudge_factor += 1
+            if li['num'] >= 99:
+                fudge_factor += 1
+            self.o(" " * (2*nest_count - fudge_factor))
+
+            if li['name'] == "ul": self.o(self.ul_item_mark + " ")
+            elif li['name'] == "ol":
+                li['num'] += 1
+                self.o(str(li['num'])+". ")
+            self.start = 1
+
+    def tag_table(self, tag, attrs, start, tag_style):
+        if start:
+            self.table = 1
+            self.o("<"+tag+">")
+        else:
+            self.table = 0
+            self.o("</"+tag+">")
 
-        if tag in ["tr", "td", "th"]:
-            if tag == 'tr':
-                self.pbr()
-            if start:
-                self.o("<"+tag+">")
-            else:
-                self.o("</"+tag+">")
+    def tag_cell(self, tag, attrs, start, tag_style):
+        if tag == 'tr':
+            self.pbr()
+        if start:
+            self.o("<"+tag+">")
+        else:
+            self.o("</"+tag+">")
 
-        if tag == "pre":
+    def tag_pre(self, tag, attrs, start, tag_style):
+        self.pbr()
+        if start:
+            self.o("<!-- START PRE -->")
+            self.startpre = 1
+            self.pre = 1
             self.pbr()
-            if start:
-                self.o("<!-- START PRE -->")
-                self.startpre = 1
-                self.pre = 1
-                self.pbr()
+        else:
+            self.pre = 0
+            if self.tags_in_pre:
+                self.o("<!-- END PRE WITH TAGS -->")
             else:
-                self.pre = 0
-                if self.tags_in_pre:
-                    self.o("<!-- END PRE WITH TAGS -->")
-                else:
-                    self.o("<!-- END PRE WITHOUT TAGS -->")
-                self.tags_in_pre = 0
-                self.p()
+                self.o("<!-- END PRE WITHOUT TAGS -->")
+            self.tags_in_pre = 0
+            self.p()
+
+    # tag name -> (handler, whether it runs before Google Docs emphasis marks)
+    tag_handlers = dict.fromkeys(heading_levels, (tag_heading, True))
+    tag_handlers.update({
+        'p': (tag_paragraph, True), 'div': (tag_paragraph, True),
+        'br': (tag_br, True), 'hr': (tag_hr, True),
+        'head': (tag_quiet, True), 'style': (tag_quiet, True), 'script': (tag_quiet, True),
+        'body': (tag_body, True), 'blockquote': (tag_blockquote, True),
+        'em': (tag_italic, True), 'i': (tag_italic, True), 'u': (tag_italic, True),
+        'strong': (tag_bold, True), 'b': (tag_bold, True),
+        'del': (tag_strikethrough, True), 'strike': (tag_strikethrough, True),
+        's': (tag_strikethrough, True),
+        'tt': (tag_tt, False), 'code': (tag_code, False), 'abbr': (tag_abbr, False),
+        'a': (tag_a, False), 'img': (tag_img, False),
+        'dl': (tag_dl, False), 'dt': (tag_dt, False), 'dd': (tag_dd, False),
+        'ol': (tag_list, False), 'ul': (tag_list, False), 'li': (tag_li, False),
+        'table': (tag_table, False),
+        'tr': (tag_cell, False), 'td': (tag_cell, False), 'th': (tag_cell, False),
+        'pre': (tag_pre, False),
+    })
+
+    def update_prefix(self):
+        """Recompute the line prefixes after a blockquote or list change."""
+        self.bq_marks = ">" * self.blockquote
+        if self.blockquote:
+            self.bq_prefix = self.bq_marks + " "
+        else:
+            self.bq_prefix = ""
+        self.pre_indent = "    " * (len(self.list) + 1)
 
     def pbr(self):
         if self.p_p == 0: self.p_p = 1
@@ -661,7 +843,7 @@ class HTML2Text(HTMLParser.HTMLParser):
                     self.drop_white_space = 0
 
             if puredata and not self.pre:
-                data = re.sub('\s+', ' ', data)
+                data = whitespace_matcher.sub(' ', data)
                 if data and data[0] == ' ':
                     self.space = 1
                     data = data[1:]
@@ -671,13 +853,11 @@ class HTML2Text(HTMLParser.HTMLParser):
                 #self.out(" :") #TODO: not output when already one there
                 self.startpre = 0
 
-            bq = (">" * self.blockquote)
-            if not (force and data and data[0] == ">") and self.blockquote: bq += " "
+            if force and data and data[0] == ">": bq = self.bq_marks
+            else: bq = self.bq_prefix
 
             if self.pre:
-                bq += "    "
-                for i in xrange(len(self.list)):
-                    bq += "    "
+                bq += self.pre_indent
                 data = data.replace("\n", "\n"+bq)
 
             if self.start:
@@ -715,6 +895,7 @@ class HTML2Text(HTMLParser.HTMLParser):
                 if self.a != newa: self.out("\n") # Don't need an extra line when nothing was done.
 
                 self.a = newa
+                self.a_index = dict([(link_key(link), i) for i, link in enumerate(newa)])
 
             if self.abbr_list and force == "end":
                 for abbr, definition in self.abbr_list.items():
@@ -735,30 +916,25 @@ class HTML2Text(HTMLParser.HTMLParser):
     def unknown_decl(self, data): pass
 
     def charref(self, name):
-        if name[0] in ['x','X']:
+        if name[0] in 'xX':
             c = int(name[1:], 16)
         else:
             c = int(name)
 
-        if not self.unicode_snob and c in unifiable_n.keys():
-            return unifiable_n[c]
-        else:
-            try:
-                return unichr(c)
-            except NameError: #Python3
-                return chr(c)
+        if self.unicode_snob: entities = snob_entities
+        else: entities = unified_entities
+        try:
+            return entities[c]
+        except KeyError:
+            return cp2text(c)
 
     def entityref(self, c):
-        if not self.unicode_snob and c in unifiable.keys():
-            return unifiable[c]
-        else:
-            try: name2cp(c)
-            except KeyError: return "&" + c + ';'
-            else:
-                try:
-                    return unichr(name2cp(c))
-                except NameError: #Python3
-                    return chr(name2cp(c))
+        if self.unicode_snob: entities = snob_entities
+        else: entities = unified_entities
+        try:
+            return entities[c]
+        except KeyError:
+            return "&" + c + ';'
 
     def replaceEntities(self, s):
         s = s.group(1)
@@ -783,25 +959,56 @@ class HTML2Text(HTMLParser.HTMLParser):
         if not self.body_width:
             return text
 
+        return ''.join(self.wrap_lines(text.split("\n")))
+
+    def wrap_lines(self, paras):
+        """Generate the wrapped output, piece by piece, for the given paragraphs."""
         assert wrap, "Requires Python 2.3."
-        result = ''
         newlines = 0
-        for para in text.split("\n"):
+        for para in paras:
             if len(para) > 0:
                 if not skipwrap(para):
                     for line in wrap(para, self.body_width):
-                        result += line + "\n"
-                    result += "\n"
+                        yield line + "\n"
+                    yield "\n"
                     newlines = 2
                 else:
                     if not onlywhite(para):
-                        result += para + "\n"
+                        yield para + "\n"
                         newlines = 1
             else:
                 if newlines < 2:
-                    result += "\n"
+                    yield "\n"
                     newlines += 1
-        return result
+
+def split_lines(chunks, empty=""):
+    """Generate the lines of the text made of chunks.
+
+    This gives the same lines as empty.join(chunks).split("\\n"), of the
+    same string type as empty.
+    """
+    pending = []
+    for chunk in chunks:
+        if "\n" in chunk:
+            lines = (empty + chunk).split("\n")
+            pending.append(lines[0])
+            yield empty.join(pending)
+            for line in lines[1:-1]:
+                yield line
+            pending = [lines[-1]]
+        else:
+            pending.append(chunk)
+    yield empty.join(pending)
+
+def terminate_lines(lines):
+    """Add back the newlines that split_lines() took off."""
+    previous = None
+    for line in lines:
+        if previous is not None:
+            yield previous + "\n"
+        previous = line
+    if previous:
+        yield previous
 
 ordered_list_matcher = re.compile(r'\d+\.\s')
 unordered_list_matcher = re.compile(r'[-\*\+]\s')
@@ -839,6 +1046,12 @@ def html2text(html, baseurl=''):
     h = HTML2Text(baseurl=baseurl)
     return h.handle(html)
 
+def html2text_lines(chunks, baseurl=''):
+    """Like html2text(), but for HTML given in chunks and generating the
+    text line by line as it becomes available."""
+    h = HTML2Text(baseurl=baseurl)
+    return h.stream(chunks)
+
 def unescape(s, unicode_snob=False):
     h = HTML2Text()
     h.unicode_snob = unicode_snob
@@ -912,7 +1125,8 @@ def main():
     h.google_doc = options.google_doc
     h.hide_strikethrough = options.hide_strikethrough
 
-    wrapwrite(h.handle(data))
+    for line in h.stream([data]):
+        wrapwrite(line)
 
 
 if __name__ == "__main__":
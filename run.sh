@@ -5,11 +5,21 @@
 SCRIPT_DIR=~/devel/remote/blogger2ikiwiki
 BLOG_DIR=~/ikiwiki/FeedingtheCloud
 
-cd $SCRIPT_DIR && rm -rf temp/
+EXPORT=$SCRIPT_DIR/feedingthecloud.xml
+BLOG_URL=http://feeding.cloud.geek.nz/
+TAGGED_FEEDS=debian,mozilla,nzoss,ubuntu,postgres,sysadmin,django,python,nodejs
+LICENSE='[Creative Commons Attribution-Share Alike 3.0 New Zealand License](http://creativecommons.org/licenses/by-sa/3.0/nz/)'
+AUTHOR_URL=http://www.blogger.com/profile/15799633745688818389=http://fmarier.org
+
+# The first --sync into a checkout filled by the old "cp -r temp/* posts/"
+# workflow stops, as that has no manifest and its comments are named
+# differently. Run it once by hand with --prune added, which deletes the
+# pages, comments and images that the export does not produce, and check
+# the result with "git status" before committing.
+cd $SCRIPT_DIR
 mkdir -p temp/
-(cd temp && ../blogger2ikiwiki.py) || exit 1
-cd $BLOG_DIR && git rm --quiet -r posts
-mkdir -p $BLOG_DIR/posts
-cp -r $SCRIPT_DIR/temp/* $BLOG_DIR/posts/
-rm $BLOG_DIR/posts/apache-aliases.conf
-cd $BLOG_DIR && git add posts && git commit --quiet -a -m "re-ran script" && git push
+(cd temp && ../blogger2ikiwiki.py --sync $BLOG_DIR/posts --blog-url $BLOG_URL \
+    --tagged-feeds $TAGGED_FEEDS --license "$LICENSE" --author-url $AUTHOR_URL \
+    $EXPORT) || exit 1
+cd $BLOG_DIR && git add -A posts
+git diff --cached --quiet || (git commit --quiet -m "re-ran script" && git push)